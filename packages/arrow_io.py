@@ -0,0 +1,54 @@
+import os
+import pandas as pd
+import pyarrow as pa
+import pyarrow.fs as pafs
+import pyarrow.parquet as pq
+
+# PARQUET_MMAP=1 opts in to memory-mapped reads: parquet files are mapped
+# instead of read into private buffers and frames come back Arrow backed
+# (dtype_backend="pyarrow") on the decoded Arrow buffers instead of being
+# copied again into numpy. Arrow IPC files (see write_ipc) are not decoded at
+# all, their frames sit on the mapped pages, which the OS shares between
+# every process reading the same file
+MEMORY_MAP = os.getenv("PARQUET_MMAP", "0") == "1"
+
+
+def arrow_dtype(arrow_type):
+    # dictionary columns stay pandas categoricals
+    if pa.types.is_dictionary(arrow_type):
+        return None
+    return pd.ArrowDtype(arrow_type)
+
+
+def to_frame(table):
+    if MEMORY_MAP:
+        return table.to_pandas(types_mapper=arrow_dtype)
+    return table.to_pandas()
+
+
+def filesystem():
+    # for pyarrow.dataset, maps the files when MEMORY_MAP is set
+    return pafs.LocalFileSystem(use_mmap=MEMORY_MAP)
+
+
+def read_table(path, **kwargs):
+    return pq.read_table(path, memory_map=MEMORY_MAP, **kwargs)
+
+
+def read_parquet(path, columns=None):
+    return to_frame(read_table(path, columns=columns))
+
+
+def write_ipc(table, path):
+    # uncompressed Arrow IPC file of an Arrow table, for read_ipc
+    with pa.OSFile(path + ".tmp", "wb") as sink:
+        with pa.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+    os.replace(path + ".tmp", path)
+
+
+def read_ipc(path):
+    # zero copy: the frame's columns point into the mapped file, which stays
+    # mapped as long as they do
+    source = pa.memory_map(path, "r")
+    return to_frame(pa.ipc.open_file(source).read_all())
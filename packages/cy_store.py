@@ -0,0 +1,70 @@
+import os
+import pyarrow as pa
+import pyarrow.parquet as pq
+import arrow_io
+
+# country/year stores (cy_ie.parquet, cy_imf_weo.parquet and the WEO vintage
+# partitions) are written sorted by KEYS, so the min/max statistics of a row
+# group cover a narrow range of countries and a country or year range lookup
+# only decodes the row groups and columns it needs
+KEYS = ["country_code", "year"]
+# about 20 countries x 50 years per row group, 8k rows per data page
+ROW_GROUP_ROWS = 1000
+PAGE_BYTES = 64 * 1024
+
+
+def write_sorted(df, path, keys=KEYS, dictionary=()):
+    # df is sorted by keys (stable) and written with statistics, a page index
+    # and the sort order in the file metadata, columns in dictionary are
+    # stored dictionary encoded. Readers never see a half written file
+    df = df.sort_values(keys, kind="stable")
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    for column in dictionary:
+        if column in table.column_names:
+            index = table.column_names.index(column)
+            table = table.set_column(index, column, table[column].dictionary_encode())
+    pq.write_table(
+        table,
+        path + ".tmp",
+        row_group_size=ROW_GROUP_ROWS,
+        data_page_size=PAGE_BYTES,
+        write_statistics=True,
+        write_page_index=True,
+        sorting_columns=pq.SortingColumn.from_ordering(
+            table.schema, [(key, "ascending") for key in keys]
+        ),
+    )
+    os.replace(path + ".tmp", path)
+
+
+def key_filters(countries=None, years=None):
+    # countries: a code or a list of codes, years: a year, a list of years
+    # or a range, e.g. range(2023, 2030)
+    filters = []
+    if countries is not None:
+        if isinstance(countries, str):
+            countries = [countries]
+        filters.append(("country_code", "in", list(countries)))
+    if isinstance(years, range):
+        filters.append(("year", ">=", years.start))
+        filters.append(("year", "<", years.stop))
+    elif years is not None:
+        if isinstance(years, int):
+            years = [years]
+        filters.append(("year", "in", list(years)))
+    return filters if len(filters) > 0 else None
+
+
+def read_cy(path, countries=None, years=None, columns=None):
+    # point and range lookups by country and year, columns: the value
+    # columns to read (e.g. WEO subjects), the keys are always included.
+    # Row groups whose statistics cannot match are skipped
+    if columns is not None:
+        columns = KEYS + [column for column in columns if column not in KEYS]
+    table = arrow_io.read_table(
+        path,
+        columns=columns,
+        filters=key_filters(countries, years),
+        partitioning=None,
+    )
+    return arrow_io.to_frame(table)
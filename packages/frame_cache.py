@@ -0,0 +1,64 @@
+import os
+from collections import OrderedDict
+import numpy as np
+import pandas as pd
+
+
+def read_only(df):
+    # rebuild the frame on non writeable copies of its numpy columns, so any
+    # in place write to a cached frame raises instead of leaking into the
+    # next caller
+    columns = {}
+    for column in df.columns:
+        values = df[column]
+        if isinstance(values.dtype, np.dtype):
+            values = values.to_numpy(copy=True)
+            values.flags.writeable = False
+        columns[column] = values
+    return pd.DataFrame(columns, index=df.index, copy=False)
+
+
+class FrameCache:
+    def __init__(self, max_bytes=2 * 1024**3):
+        # frames are kept in least recently used order and evicted once
+        # their deep memory usage goes over max_bytes
+        self.max_bytes = max_bytes
+        self.frames = OrderedDict()
+        self.sizes = {}
+        self.nbytes = 0
+
+    def load(self, key, files, loader):
+        # the files' mtimes and sizes are part of the key, so a frame is
+        # reloaded as soon as one of its files changes on disk
+        stamp = []
+        for file in sorted(files):
+            stat = os.stat(file)
+            stamp.append((file, stat.st_mtime_ns, stat.st_size))
+        cache_key = (key, tuple(stamp))
+
+        if cache_key in self.frames:
+            self.frames.move_to_end(cache_key)
+            return self.frames[cache_key].copy(deep=False)
+
+        for stale_key in [k for k in self.frames if k[0] == key]:
+            self.evict(stale_key)
+
+        df = loader()
+        size = int(df.memory_usage(index=True, deep=True).sum())
+        df = read_only(df)
+        if size <= self.max_bytes:
+            self.frames[cache_key] = df
+            self.sizes[cache_key] = size
+            self.nbytes = self.nbytes + size
+            while self.nbytes > self.max_bytes:
+                self.evict(next(iter(self.frames)))
+        return df.copy(deep=False)
+
+    def evict(self, cache_key):
+        del self.frames[cache_key]
+        self.nbytes = self.nbytes - self.sizes.pop(cache_key)
+
+    def clear(self):
+        self.frames.clear()
+        self.sizes.clear()
+        self.nbytes = 0
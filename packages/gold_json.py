@@ -0,0 +1,103 @@
+import os
+import gzip
+import json
+import math
+import run_metrics
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+def format_number(value, round_val):
+    # shortest fixed decimal text for round_val digits, NaN and inf -> null
+    if math.isnan(value) or math.isinf(value):
+        return "null"
+    text = f"{value:.{round_val}f}"
+    if "." in text:
+        text = text.rstrip("0").rstrip(".")
+    return "0" if text == "-0" else text
+
+
+def nested_json(values, present, round_val):
+    # {"entity":{"year":value,...},...}, present masks the cells to emit
+    years = [json.dumps(str(year)) for year in values.columns.tolist()]
+    rows = values.to_numpy(dtype=float).tolist()
+    masks = (
+        present.to_numpy(dtype=bool).tolist()
+        if present is not None
+        else [[True] * len(years)] * len(rows)
+    )
+    entities = []
+    for entity, row, mask in zip(values.index.tolist(), rows, masks):
+        cells = ",".join(
+            f"{year}:{format_number(val, round_val)}"
+            for year, val, keep in zip(years, row, mask)
+            if keep
+        )
+        entities.append(f"{json.dumps(str(entity))}:{{{cells}}}")
+    return "{" + ",".join(entities) + "}"
+
+
+def columnar_json(values, present, round_val):
+    # {"years":[...],"values":{"entity":[value per year],...}}, cells that
+    # are not present are null
+    years = ",".join(str(year) for year in values.columns.tolist())
+    rows = values.to_numpy(dtype=float).tolist()
+    masks = (
+        present.to_numpy(dtype=bool).tolist()
+        if present is not None
+        else [[True] * len(values.columns)] * len(rows)
+    )
+    entities = []
+    for entity, row, mask in zip(values.index.tolist(), rows, masks):
+        cells = ",".join(
+            format_number(val, round_val) if keep else "null"
+            for val, keep in zip(row, mask)
+        )
+        entities.append(f"{json.dumps(str(entity))}:[{cells}]")
+    return '{"years":[' + years + '],"values":{' + ",".join(entities) + "}}"
+
+
+def write_gold_json(
+    path, values, present=None, round_val=2, layout="nested", compress=()
+):
+    # values: entity x year frame, written as compact valid JSON with null
+    # for missing values and at most round_val decimals. compress may hold
+    # "gzip" and "br" to also write pre-compressed .gz / .br siblings
+    if layout == "columnar":
+        text = columnar_json(values, present, round_val)
+    elif layout == "nested":
+        text = nested_json(values, present, round_val)
+    else:
+        raise ValueError(f"unknown gold layout {layout}")
+    data = text.encode("utf-8")
+
+    with open(path, "wb") as json_file:
+        json_file.write(data)
+    run_metrics.add("bytes_written", len(data))
+
+    if "br" in compress and brotli is None:
+        print(f"brotli is not installed, {path}.br not written")
+    siblings = [
+        (".gz", "gzip" in compress, gzip_bytes),
+        (".br", "br" in compress and brotli is not None, brotli_bytes),
+    ]
+    for suffix, enabled, compressor in siblings:
+        if enabled:
+            with open(path + suffix, "wb") as compressed_file:
+                compressed = compressor(data)
+                compressed_file.write(compressed)
+            run_metrics.add("bytes_written", len(compressed))
+        elif os.path.exists(path + suffix):
+            # a stale sibling would be served instead of the new file
+            os.remove(path + suffix)
+
+
+def gzip_bytes(data):
+    return gzip.compress(data, compresslevel=9, mtime=0)
+
+
+def brotli_bytes(data):
+    return brotli.compress(data, quality=11)
@@ -0,0 +1,21 @@
+import numpy as np
+import pandas as pd
+
+
+def ratio_indicators(df, ratios):
+    # ratios: {name: (numerator column, denominator column)}. Every ratio is
+    # divided straight into its column of one result array, x/0 and 0/0
+    # give NaN. Returns a frame of the ratios on the index of df
+    names = list(ratios)
+    values = np.empty((len(df), len(names)), order="F")
+    with np.errstate(divide="ignore", invalid="ignore"):
+        for i, name in enumerate(names):
+            numerator, denominator = ratios[name]
+            np.divide(
+                df[numerator].to_numpy(dtype=float),
+                df[denominator].to_numpy(dtype=float),
+                out=values[:, i],
+            )
+    values[np.isinf(values)] = np.nan
+    # values is not shared, the frame takes it over instead of copying it
+    return pd.DataFrame(values, index=df.index, columns=names, copy=False)
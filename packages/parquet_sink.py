@@ -0,0 +1,96 @@
+import os
+import json
+import shutil
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+
+class ParquetPageWriter:
+    def __init__(self, path, query=None):
+        # every page is first spooled to its own file next to path together
+        # with a checkpoint of the next $skip, close() then streams the pages
+        # into path one row group at a time. A pull that dies half way resumes
+        # from the checkpoint as long as it is for the same query
+        self.path = path
+        self.query = query
+        self.spool_path = path + ".pages"
+        self.checkpoint_path = os.path.join(self.spool_path, "checkpoint.json")
+        self.schema = None
+        self.next_skip = 0
+        self.rows = 0
+        self.pages = []
+
+        if os.path.exists(self.checkpoint_path):
+            with open(self.checkpoint_path, "r") as json_file:
+                checkpoint = json.load(json_file)
+            if checkpoint["query"] == query and len(checkpoint["pages"]) > 0:
+                self.next_skip = checkpoint["next_skip"]
+                self.rows = checkpoint["rows"]
+                self.pages = checkpoint["pages"]
+                self.schema = pq.read_schema(self.page_path(self.pages[0]))
+        if len(self.pages) == 0 and os.path.exists(self.spool_path):
+            shutil.rmtree(self.spool_path)
+
+    def page_path(self, page):
+        return os.path.join(self.spool_path, page)
+
+    def write(self, page, skip):
+        # page: arrow table or DataFrame
+        if isinstance(page, pa.Table):
+            table = page
+        else:
+            table = pa.Table.from_pandas(page, preserve_index=False)
+        if self.schema is None:
+            # schema is fixed by the first page, columns that are entirely
+            # null on it are stored as string so later values still fit
+            fields = [
+                (
+                    pa.field(field.name, pa.string())
+                    if pa.types.is_null(field.type)
+                    else field
+                )
+                for field in table.schema
+            ]
+            self.schema = pa.schema(fields, metadata=table.schema.metadata)
+        table = self.conform(table)
+
+        os.makedirs(self.spool_path, exist_ok=True)
+        page = f"{skip:012d}.parquet"
+        pq.write_table(table, self.page_path(page) + ".tmp")
+        os.replace(self.page_path(page) + ".tmp", self.page_path(page))
+        if page not in self.pages:
+            self.pages.append(page)
+            self.rows = self.rows + table.num_rows
+        self.next_skip = skip + table.num_rows
+        self.save_checkpoint()
+
+    def save_checkpoint(self):
+        checkpoint = {
+            "query": self.query,
+            "next_skip": self.next_skip,
+            "rows": self.rows,
+            "pages": self.pages,
+        }
+        with open(self.checkpoint_path + ".tmp", "w") as json_file:
+            json.dump(checkpoint, json_file)
+        os.replace(self.checkpoint_path + ".tmp", self.checkpoint_path)
+
+    def conform(self, table):
+        columns = []
+        for field in self.schema:
+            if field.name in table.column_names:
+                columns.append(table[field.name].cast(field.type))
+            else:
+                columns.append(pa.nulls(table.num_rows, field.type))
+        return pa.Table.from_arrays(columns, schema=self.schema)
+
+    def close(self):
+        if len(self.pages) == 0:
+            return
+        # one page in memory at a time, one row group per page
+        writer = pq.ParquetWriter(self.path + ".tmp", self.schema)
+        for page in self.pages:
+            writer.write_table(pq.read_table(self.page_path(page), schema=self.schema))
+        writer.close()
+        os.replace(self.path + ".tmp", self.path)
+        shutil.rmtree(self.spool_path)
@@ -0,0 +1,192 @@
+import os
+import sys
+import csv
+import json
+import time
+import bisect
+import cProfile
+import datetime
+import threading
+import tracemalloc
+import contextlib
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+try:
+    import pyinstrument
+except ImportError:
+    pyinstrument = None
+
+# RUN_REPORT_PATH: directory of the run reports, RUN_PROFILE: "cprofile" or
+# "pyinstrument" to also profile every top level stage into that directory
+REPORT_PATH = os.getenv("RUN_REPORT_PATH", os.path.join("data", "run_reports"))
+PROFILE = os.getenv("RUN_PROFILE", "")
+# RUN_TRACEMALLOC=1 records peak_alloc_mb, the peak of the Python and numpy
+# allocations traced during every top level stage, its own peak unlike
+# process_peak_rss_mb, e.g. to check that a change does not bring back whole
+# frame copies. Arrow buffers are not traced
+TRACEMALLOC = os.getenv("RUN_TRACEMALLOC", "0") == "1"
+LATENCY_BUCKETS = [0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0]
+COUNTERS = ["rows_in", "rows_out", "bytes_read", "bytes_written"]
+
+# finished stages and HTTP latency counts of this process
+records = []
+latencies = {}
+lock = threading.Lock()
+local = threading.local()
+
+
+def process_peak_rss_mb():
+    # high-water mark of this process so far, not of one stage: a stage after
+    # the largest one reports the same value. ru_maxrss is KB on Linux, bytes
+    # on macOS
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(peak / (1024**2 if sys.platform == "darwin" else 1024), 1)
+
+
+def path_bytes(path):
+    # size of a file or of every file below a directory
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+    return sum(
+        os.path.getsize(os.path.join(root, file))
+        for root, _, files in os.walk(path)
+        for file in files
+    )
+
+
+def stage_stack():
+    if not hasattr(local, "stack"):
+        local.stack = []
+    return local.stack
+
+
+@contextlib.contextmanager
+def stage(name):
+    # times the block and collects the counters add() reports inside it
+    # from the same thread. Top level stages are profiled when RUN_PROFILE is set
+    record = {"stage": name, "pid": os.getpid(), **{key: 0 for key in COUNTERS}}
+    stack = stage_stack()
+    profiler = start_profile() if len(stack) == 0 else None
+    if TRACEMALLOC and len(stack) == 0:
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+        tracemalloc.reset_peak()
+    stack.append(record)
+    start_time = time.time()
+    try:
+        yield record
+    finally:
+        record["seconds"] = round(time.time() - start_time, 3)
+        record["process_peak_rss_mb"] = process_peak_rss_mb()
+        stack.pop()
+        if TRACEMALLOC and len(stack) == 0:
+            # process wide, stages running on other threads at the same
+            # time are included
+            record["peak_alloc_mb"] = round(
+                tracemalloc.get_traced_memory()[1] / 1024**2, 1
+            )
+        stop_profile(profiler, name)
+        with lock:
+            records.append(record)
+
+
+def add(key, value):
+    # adds value to a counter of the innermost stage of this thread, outside
+    # of any stage it is dropped
+    stack = stage_stack()
+    if len(stack) > 0:
+        stack[-1][key] = stack[-1].get(key, 0) + value
+
+
+def record(name, **fields):
+    # a finished stage measured by the caller, e.g. one table/year of a pull
+    with lock:
+        records.append({"stage": name, "pid": os.getpid(), **fields})
+
+
+def observe_latency(table, seconds):
+    with lock:
+        counts = latencies.setdefault(table, [0] * (len(LATENCY_BUCKETS) + 1))
+        counts[bisect.bisect_left(LATENCY_BUCKETS, seconds)] += 1
+
+
+def take(start):
+    # records finished since len(records) was start, removed from this
+    # process so a worker hands each of them back once
+    with lock:
+        taken = records[start:]
+        del records[start:]
+    return taken
+
+
+def merge(taken):
+    with lock:
+        records.extend(taken)
+
+
+def start_profile():
+    if PROFILE == "cprofile":
+        profiler = cProfile.Profile()
+        profiler.enable()
+        return profiler
+    if PROFILE == "pyinstrument":
+        if pyinstrument is None:
+            print("pyinstrument is not installed, stages are not profiled")
+            return None
+        profiler = pyinstrument.Profiler()
+        profiler.start()
+        return profiler
+    return None
+
+
+def stop_profile(profiler, name):
+    if profiler is None:
+        return
+    os.makedirs(REPORT_PATH, exist_ok=True)
+    path = os.path.join(REPORT_PATH, name.replace(" ", "_").replace("/", "_"))
+    if isinstance(profiler, cProfile.Profile):
+        profiler.disable()
+        profiler.dump_stats(path + ".prof")
+    else:
+        profiler.stop()
+        with open(path + ".html", "w") as html_file:
+            html_file.write(profiler.output_html())
+
+
+def write_report(run):
+    # {run}_{timestamp}.json with every stage and the HTTP latency histogram
+    # per table, and a .csv with one line per stage
+    os.makedirs(REPORT_PATH, exist_ok=True)
+    now = datetime.datetime.now(datetime.timezone.utc)
+    path = os.path.join(REPORT_PATH, f"{run}_{now.strftime('%Y%m%dT%H%M%S')}")
+    labels = [f"<={bound}" for bound in LATENCY_BUCKETS] + [f">{LATENCY_BUCKETS[-1]}"]
+    with lock:
+        report = {
+            "run": run,
+            "finished_at": now.isoformat(),
+            "stages": list(records),
+            "http_latency_seconds": {
+                table: dict(zip(labels, counts)) for table, counts in latencies.items()
+            },
+        }
+    with open(path + ".json", "w") as json_file:
+        json.dump(report, json_file, indent=4)
+
+    columns = [
+        "stage",
+        "pid",
+        "seconds",
+        "process_peak_rss_mb",
+        "peak_alloc_mb",
+    ] + COUNTERS
+    with open(path + ".csv", "w", newline="") as csv_file:
+        writer = csv.DictWriter(csv_file, fieldnames=columns, extrasaction="ignore")
+        writer.writeheader()
+        writer.writerows(report["stages"])
+    return path + ".json"
@@ -0,0 +1,44 @@
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+import run_metrics
+
+
+def timed_call(name, func):
+    # runs func as a stage of its worker process and hands the stage records
+    # back, the task's own record is the last one
+    start = len(run_metrics.records)
+    with run_metrics.stage(name):
+        func()
+    return run_metrics.take(start)
+
+
+def run_graph(tasks, max_workers=None, initializer=None):
+    # tasks: {name: (func, [names of tasks it depends on])}, each func runs in
+    # a worker process as soon as everything it depends on has finished.
+    # Where workers are forked (Linux), frames the caller already loaded are
+    # shared read only instead of being read again. Under spawn (macOS,
+    # Windows) workers start from a fresh import, they read their own inputs
+    # and settings made by the caller, e.g. pandas options, only reach them
+    # through initializer. Stage records of the workers are merged into
+    # run_metrics. Returns {name: seconds}
+    timings = {}
+    remaining = dict(tasks)
+    running = {}
+    with ProcessPoolExecutor(
+        max_workers=max_workers, initializer=initializer
+    ) as executor:
+        while remaining or running:
+            for name, (func, depends_on) in list(remaining.items()):
+                if all(dep in timings for dep in depends_on):
+                    running[executor.submit(timed_call, name, func)] = name
+                    del remaining[name]
+            if not running:
+                raise ValueError(f"unresolvable dependencies: {sorted(remaining)}")
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                taken = future.result()
+                run_metrics.merge(taken)
+                timings[name] = taken[-1]["seconds"]
+                print("--- %s: %s seconds ---" % (name, timings[name]))
+    return timings
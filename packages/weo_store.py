@@ -0,0 +1,132 @@
+import os
+import re
+import json
+import shutil
+import pyarrow as pa
+from cy_store import key_filters, write_sorted
+import arrow_io
+
+# one partition per WEO release: data/imf_weo/vintage=Apr2024/...
+STORE_PATH = os.path.join("data", "imf_weo")
+MONTHS = "Jan Feb Mar Apr May Jun Jul Aug Sep Oct Nov Dec".split()
+KEY_COLUMNS = ["country_code", "weo_subject_code"]
+
+
+def vintage_of(filename):
+    # "WEOApr2024all.xls" -> "Apr2024"
+    match = re.search(r"WEO([A-Z][a-z]{2})(\d{4})", os.path.basename(filename))
+    if match is None or match.group(1) not in MONTHS:
+        raise ValueError(f"no WEO vintage in file name {filename}")
+    return match.group(1) + match.group(2)
+
+
+def vintage_order(vintage):
+    return int(vintage[3:]), MONTHS.index(vintage[:3])
+
+
+def partition_path(vintage, store_path=STORE_PATH):
+    return os.path.join(store_path, f"vintage={vintage}")
+
+
+def vintages(store_path=STORE_PATH):
+    # complete partitions only, oldest first
+    if not os.path.isdir(store_path):
+        return []
+    found = [
+        name[len("vintage=") :]
+        for name in os.listdir(store_path)
+        if name.startswith("vintage=")
+        and os.path.exists(os.path.join(store_path, name, "source.json"))
+    ]
+    return sorted(found, key=vintage_order)
+
+
+def latest_vintage(store_path=STORE_PATH):
+    found = vintages(store_path)
+    if len(found) == 0:
+        raise FileNotFoundError(f"no WEO vintage in {store_path}")
+    return found[-1]
+
+
+def source_hash(vintage, store_path=STORE_PATH):
+    path = os.path.join(partition_path(vintage, store_path), "source.json")
+    if not os.path.exists(path):
+        return None
+    with open(path, "r") as json_file:
+        return json.load(json_file)["sha256"]
+
+
+def write_vintage(vintage, cy_imf_weo, estimate_after, sha256, store_path=STORE_PATH):
+    # the partition is built next to the store and swapped in whole, so
+    # readers never see half a vintage and other vintages are left untouched
+    path = partition_path(vintage, store_path)
+    tmp_path = path + ".tmp"
+    if os.path.exists(tmp_path):
+        shutil.rmtree(tmp_path)
+    os.makedirs(tmp_path)
+    # country and subject codes are stored dictionary encoded
+    write_sorted(
+        cy_imf_weo,
+        os.path.join(tmp_path, "cy_imf_weo.parquet"),
+        dictionary=KEY_COLUMNS,
+    )
+    write_sorted(
+        estimate_after,
+        os.path.join(tmp_path, "estimate_after.parquet"),
+        keys=KEY_COLUMNS,
+        dictionary=KEY_COLUMNS,
+    )
+    with open(os.path.join(tmp_path, "source.json"), "w") as json_file:
+        json.dump({"vintage": vintage, "sha256": sha256}, json_file, indent=4)
+    if os.path.exists(path):
+        shutil.rmtree(path)
+    os.replace(tmp_path, path)
+
+
+def read_partition(name, vintage, columns, categorical, store_path, filters=None):
+    if vintage is None:
+        vintage = latest_vintage(store_path)
+    path = os.path.join(partition_path(vintage, store_path), name)
+    if not os.path.exists(path):
+        raise FileNotFoundError(f"WEO vintage {vintage} not found in {store_path}")
+    table = arrow_io.read_table(
+        path, columns=columns, filters=filters, partitioning=None
+    )
+    if not categorical:
+        for column in KEY_COLUMNS:
+            if column in table.column_names:
+                index = table.column_names.index(column)
+                table = table.set_column(index, column, table[column].cast(pa.string()))
+    return arrow_io.to_frame(table)
+
+
+def load_weo(
+    vintage=None,
+    columns=None,
+    categorical=False,
+    store_path=STORE_PATH,
+    countries=None,
+    years=None,
+):
+    # country/year x subject frame of one vintage, the latest when vintage is
+    # None. Only that partition is read, keys come back as strings unless
+    # categorical is set. columns: subjects to read besides the keys,
+    # countries and years: lookups as in cy_store.read_cy
+    if columns is not None:
+        columns = ["country_code", "year"] + [
+            column for column in columns if column not in ["country_code", "year"]
+        ]
+    return read_partition(
+        "cy_imf_weo.parquet",
+        vintage,
+        columns,
+        categorical,
+        store_path,
+        key_filters(countries, years),
+    )
+
+
+def load_estimate_after(vintage=None, categorical=False, store_path=STORE_PATH):
+    return read_partition(
+        "estimate_after.parquet", vintage, None, categorical, store_path
+    )
@@ -1,13 +1,72 @@
 from azure.identity import ClientSecretCredential
+from concurrent.futures import ThreadPoolExecutor
+from email.utils import parsedate_to_datetime
+from requests.adapters import HTTPAdapter
+import datetime
+import threading
+import random
+import time
 import requests
 import rdata
+import pyarrow as pa
+import pyarrow.json as pj
 import os
+import run_metrics
 
 from dotenv import load_dotenv
 
+RETRY_STATUS = {429, 500, 502, 503, 504}
+
+
+def odata_literal(value):
+    if isinstance(value, str):
+        return "'" + value.replace("'", "''") + "'"
+    return str(value)
+
+
+def retry_after_seconds(response):
+    # Retry-After is either a number of seconds or an HTTP date
+    value = response.headers.get("Retry-After")
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        retry_at = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    now = datetime.datetime.now(datetime.timezone.utc)
+    return max(0.0, (retry_at - now).total_seconds())
+
+
+def arrow_page(content, schema):
+    # an OData response body {"value": [{...}, ...], ...} parsed straight
+    # into an arrow table of schema by pyarrow's JSON reader, fields outside
+    # the schema are ignored and missing ones are null
+    body = pj.read_json(
+        pa.BufferReader(content),
+        read_options=pj.ReadOptions(block_size=len(content) + 1),
+        parse_options=pj.ParseOptions(
+            explicit_schema=pa.schema([("value", pa.list_(pa.struct(schema)))]),
+            unexpected_field_behavior="ignore",
+            newlines_in_values=True,
+        ),
+    )
+    rows = [chunk.flatten() for chunk in body.column("value").chunks]
+    return pa.Table.from_struct_array(pa.concat_arrays(rows)).cast(schema)
+
 
 class XmartExtractor:
-    def __init__(self):
+    def __init__(
+        self,
+        max_workers=8,
+        max_retries=6,
+        backoff=1.0,
+        max_backoff=60.0,
+        timeout=(10.0, 300.0),
+    ):
         # key = rdata.read_rda("./WIISEMART_OData_key.RData")
         # authn = key["authn"]
         # authn_resource = authn["resource"][0]
@@ -19,19 +78,212 @@ class XmartExtractor:
         authn_resource = os.getenv("AUTHN_RESOURCE")
         authn_tenant = os.getenv("AUTHN_TENANT")
 
-        credential = ClientSecretCredential(
+        self.credential = ClientSecretCredential(
             tenant_id=authn_tenant, client_id=authn_app, client_secret=authn_password
         )
-
-        self.access_token = credential.get_token(authn_resource + "/.default")
-        self.headers = {"Authorization": f"Bearer {self.access_token.token}"}
+        self.scope = authn_resource + "/.default"
+        self.token_lock = threading.Lock()
+        self.access_token = None
         self.base_url = "https://extranet.who.int/xmart-api/odata/WIISE/"
 
-    def get(self, path):
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        # (connect, read) seconds, a stalled connection is retried like a
+        # dropped one instead of hanging the pull
+        self.timeout = timeout
+
+        # one pooled session shared by every worker thread
+        self.max_workers = max_workers
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=max_workers, pool_maxsize=max_workers)
+        self.session.mount("https://", adapter)
+
+    def query(self, table, select=None, filter=None):
+        # select: list of columns, filter: {column: value or list of values},
+        # e.g. query("REF_FINANCING", ["COUNTRY", "VALUE"], {"YEAR": [2020]})
+        # gives "REF_FINANCING?$select=COUNTRY,VALUE&$filter=YEAR in (2020)"
+        options = []
+        if select:
+            options.append("$select=" + ",".join(select))
+        if filter:
+            predicates = []
+            for column, value in filter.items():
+                if isinstance(value, (list, tuple, set)):
+                    values = ",".join(odata_literal(v) for v in value)
+                    predicates.append(f"{column} in ({values})")
+                else:
+                    predicates.append(f"{column} eq {odata_literal(value)}")
+            options.append("$filter=" + " and ".join(predicates))
+        return f"{table}?" + "&".join(options)
+
+    @property
+    def headers(self):
+        return {"Authorization": f"Bearer {self.token()}"}
+
+    def token(self, force=False):
+        # the cached token is renewed five minutes before it expires, so a
+        # long pull never sends an expired one
+        with self.token_lock:
+            if (
+                force
+                or self.access_token is None
+                or self.access_token.expires_on - time.time() < 300
+            ):
+                self.access_token = self.credential.get_token(self.scope)
+            return self.access_token.token
+
+    def get(self, path, raw=False):
+        # the decoded JSON response, or its body bytes when raw is set
         print(path)
-        response = requests.get(self.base_url + path, headers=self.headers)
+        for attempt in range(self.max_retries + 1):
+            headers = self.headers
+            start_time = time.time()
+            try:
+                response = self.session.get(
+                    self.base_url + path, headers=headers, timeout=self.timeout
+                )
+            except (requests.ConnectionError, requests.Timeout):
+                if attempt == self.max_retries:
+                    raise
+                time.sleep(self.backoff_seconds(attempt))
+                continue
+            run_metrics.observe_latency(path.split("?")[0], time.time() - start_time)
+
+            if response.status_code == 200:
+                return response.content if raw else response.json()
+            if attempt == self.max_retries:
+                break
+            if response.status_code == 401:
+                self.token(force=True)
+            elif response.status_code in RETRY_STATUS:
+                delay = retry_after_seconds(response)
+                if delay is None:
+                    delay = self.backoff_seconds(attempt)
+                print(f"{response.status_code} on {path}, retrying in {delay:.1f}s")
+                time.sleep(delay)
+            else:
+                break
+        raise requests.HTTPError(
+            f"{response.status_code} for {path}", response=response
+        )
+
+    def backoff_seconds(self, attempt):
+        # exponential backoff with full jitter
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2**attempt))
+
+    def iter_pages(
+        self, queries, chunk=10000, start=None, schemas=None, first_request=None
+    ):
+        # queries: {key: "TABLE?$filter=..."}, pages are yielded as
+        # (key, skip, data) key by key, in $skip order, while later pages and
+        # keys are fetched ahead on a bounded thread pool. Every key ends with
+        # an empty page, start: {key: skip} resumes keys from a checkpoint.
+        # data is the list of row dicts, or for keys in schemas ({key: arrow
+        # schema}) an arrow table parsed from the response bytes on the pool.
+        # A page shorter than chunk is the last one, its empty page is not
+        # requested, and a key only gets more than one page fetched ahead once
+        # it has returned a full page, so small table/years cost one request.
+        # first_request: a dict that gets {key: time.time()} of the first
+        # request sent for every key
+        keys = list(queries)
+        pending = {key: {} for key in keys}
+        full = set()
+        first_skip = {key: (start or {}).get(key, 0) for key in keys}
+        next_skip = dict(first_skip)
+        limit = 2 * self.max_workers
+
+        def page_path(key, skip):
+            return f"{queries[key]}&$top={chunk}&$skip={skip}"
+
+        def fetch(key, skip):
+            if first_request is not None:
+                first_request.setdefault(key, time.time())
+            if schemas is not None and key in schemas:
+                return arrow_page(
+                    self.get(page_path(key, skip), raw=True), schemas[key]
+                )
+            return self.get(page_path(key, skip))["value"]
+
+        def empty(key):
+            if schemas is not None and key in schemas:
+                return schemas[key].empty_table()
+            return []
+
+        def in_flight():
+            return sum(len(futures) for futures in pending.values())
+
+        def depth(key):
+            # pages of key that may be in flight at once
+            if key not in full:
+                for future in pending[key].values():
+                    if (
+                        future.done()
+                        and not future.cancelled()
+                        and future.exception() is None
+                        and len(future.result()) >= chunk
+                    ):
+                        full.add(key)
+                        break
+            return self.max_workers if key in full else 1
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+
+            def submit(key):
+                skip = next_skip[key]
+                pending[key][skip] = executor.submit(fetch, key, skip)
+                next_skip[key] = skip + chunk
+
+            def fill(current):
+                # the current key always has its next page queued, the rest
+                # of the window is shared round-robin with the following keys
+                if not pending[keys[current]]:
+                    submit(keys[current])
+                submitted = True
+                while submitted and in_flight() < limit:
+                    submitted = False
+                    for key in keys[current:]:
+                        if in_flight() >= limit:
+                            break
+                        if len(pending[key]) < depth(key):
+                            submit(key)
+                            submitted = True
+
+            try:
+                for index, key in enumerate(keys):
+                    skip = first_skip[key]
+                    while True:
+                        fill(index)
+                        data = pending[key].pop(skip).result()
+                        if len(data) >= chunk:
+                            full.add(key)
+                        yield key, skip, data
+                        if len(data) < chunk:
+                            # pages past the end of this key are no longer needed
+                            for future in pending[key].values():
+                                future.cancel()
+                            pending[key] = {}
+                            if len(data) > 0:
+                                yield key, skip + len(data), empty(key)
+                            break
+                        skip = skip + chunk
+            finally:
+                # on errors or an early close nothing else is fetched
+                for futures in pending.values():
+                    for future in futures.values():
+                        future.cancel()
+
+    def count(self, path):
+        # row count of a query without transferring any rows
+        try:
+            response = self.get(f"{path}&$count=true&$top=0")
+        except requests.RequestException:
+            return None
+        return response.get("@odata.count")
 
-        if response.status_code == 200:
-            return response.json()
-        else:
-            return response.status_code
+    def counts(self, queries):
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = {
+                key: executor.submit(self.count, path) for key, path in queries.items()
+            }
+            return {key: future.result() for key, future in futures.items()}
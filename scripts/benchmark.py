@@ -0,0 +1,450 @@
+import datetime
+import json
+import os
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+import pandas as pd
+
+SCRIPTS_PATH = os.path.abspath(os.path.dirname(__file__))
+sys.path.append(os.path.abspath(os.path.join(SCRIPTS_PATH, "..", "packages")))
+
+# BENCH_SCALES: countries x years x units per country/year/type, e.g.
+# "200x8x1,800x8x4". BENCH_STAGES: subset of STAGES. Results are appended
+# to BENCH_RESULTS, a stage that got slower than BENCH_TOLERANCE times its
+# previous median at the same scale is reported and the run exits with 1
+SCALES = os.getenv("BENCH_SCALES", "200x8x1")
+RESULTS_PATH = os.getenv(
+    "BENCH_RESULTS", os.path.join("data", "benchmark_results.jsonl")
+)
+TOLERANCE = float(os.getenv("BENCH_TOLERANCE", "1.2"))
+FIRST_YEAR = 2018
+STAGES = [
+    "extract",
+    "imf_weo_csv_parquet",
+    "imf_weo_required_columns",
+    "whdh_gold_data",
+]
+
+REGIONS = ["AFRO", "AMRO", "EMRO", "EURO", "SEARO", "WPRO"]
+GAVI = [
+    "Gavi low income",
+    "Gavi low-middle income",
+    "non-Gavi middle income",
+    "High income",
+]
+AD_TYPES = ["TEV", "TERI", "GEV", "GERI", "OTHER"]
+FINANCE_CODES = [
+    "LP",
+    "NGDPD",
+    "CHE_USD",
+    "PHC_USD",
+    "GGHED_USD",
+    "EXT_USD",
+    "GGHED_GGE",
+]
+WEO_SUBJECTS = {
+    # subject: (low, high) of the generated values
+    "GGX_NGDP": (15, 45),
+    "GGXONLB_NGDP": (-5, 5),
+    "GGXCNL_NGDP": (-8, 4),
+    "NGDPRPC": (1e3, 1e6),
+    "NGDPPC": (1e3, 1e6),
+    "NGDPDPC": (300, 9e4),
+    "NGDP_D": (50, 250),
+}
+
+
+def parse_scale(scale):
+    countries, years, units = (int(part) for part in scale.split("x"))
+    return countries, years, units
+
+
+def countries_frame(countries):
+    codes = [f"C{i:04d}" for i in range(countries)]
+    return pd.DataFrame(
+        {
+            "COUNTRY": codes,
+            "NAMEWORKEN": [f"Country {code}" for code in codes],
+            "WHOREGIONC": [REGIONS[i % len(REGIONS)] for i in range(countries)],
+            "GAVI_INCOME_STATUS": [GAVI[i % len(GAVI)] for i in range(countries)],
+        }
+    )
+
+
+def cross(left, right):
+    return pd.merge(left, right, how="cross")
+
+
+def generate(data_path, countries, years, units, seed=0):
+    # raw xMart tables, GNI csv files and a WEO export shaped like the real
+    # ones. units repeats every MT_AD_IA2030_FINANCING country/year/type row,
+    # as subnational or per-source reporting does. Returns the row count
+    rng = np.random.default_rng(seed)
+    os.makedirs(os.path.join(data_path, "gni"), exist_ok=True)
+    os.makedirs(os.path.join(data_path, "IMF_WEO_IN"), exist_ok=True)
+    country_df = countries_frame(countries)
+    rows = 0
+
+    def write(df, table, year):
+        nonlocal rows
+        rows += len(df)
+        df.to_parquet(os.path.join(data_path, f"{table}_{year}.parquet"), index=False)
+
+    for year in range(FIRST_YEAR, FIRST_YEAR + years):
+        ad_df = cross(
+            cross(country_df, pd.DataFrame({"TYPE": AD_TYPES})),
+            pd.DataFrame({"UNIT": range(units)}),
+        ).drop(columns="UNIT")
+        ad_df.insert(4, "YEAR", year)
+        ad_df["VALUE_TRANSFORMED"] = rng.random(len(ad_df)) * 1e6
+        ad_df.loc[rng.random(len(ad_df)) < 0.05, "VALUE_TRANSFORMED"] = np.nan
+        write(ad_df, "MT_AD_IA2030_FINANCING", year)
+
+        pop_df = cross(
+            country_df[["COUNTRY"]].rename(columns={"COUNTRY": "COUNTRY_FK"}),
+            pd.DataFrame({"POP_TYPE_FK": ["SURVIVING_INFANT", "BIRTHS"]}),
+        )
+        pop_df["YEAR"] = year
+        pop_df["VALUE"] = rng.integers(1e3, 1e6, len(pop_df)).astype(float)
+        pop_df["POP_SOURCE_FK"] = "UNPD2022"
+        pop_df["GENDER_FK"] = "BOTH"
+        write(pop_df, "REF_POPULATIONS", year)
+
+        finance_df = cross(
+            country_df[["COUNTRY"]], pd.DataFrame({"INDCODE": FINANCE_CODES})
+        )
+        finance_df["YEAR"] = year
+        finance_df["VALUE"] = rng.random(len(finance_df)) * 1e5
+        write(
+            finance_df[["COUNTRY", "YEAR", "INDCODE", "VALUE"]], "REF_FINANCING", year
+        )
+
+        bop_df = pd.DataFrame(
+            {
+                "NAME": country_df["NAMEWORKEN"],
+                "YEAR": year,
+                "BOP": rng.random(countries) * 100,
+            }
+        )
+        write(bop_df, "V_AD_COV_BOP_LONG", year)
+
+        coverage_df = pd.DataFrame(
+            {
+                "COUNTRY": country_df["COUNTRY"],
+                "YEAR": year,
+                "VACCINECODE": "DTPCV1",
+                "COVERAGE_CATEGORY": "WUENIC",
+                "PERCENTAGE": rng.integers(50, 100, countries).astype(float),
+                "TARGETNUMBER": rng.integers(1e3, 1e6, countries).astype(float),
+            }
+        )
+        write(coverage_df, "AD_COVERAGES", year)
+
+    gni_years = pd.DataFrame({"year": range(FIRST_YEAR, FIRST_YEAR + years)})
+    gni_df = cross(
+        country_df[["NAMEWORKEN", "COUNTRY"]].rename(
+            columns={"NAMEWORKEN": "country", "COUNTRY": "country_code"}
+        ),
+        gni_years,
+    )
+    for gni_file, gni_column in [
+        ("current_gni.csv", "current_gni_usd"),
+        ("constant_gni_2015.csv", "constant_gni_2015_usd"),
+    ]:
+        gni_df[gni_column] = rng.random(len(gni_df)) * 1e4
+        gni_df[["country", "country_code", "year", gni_column]].to_csv(
+            os.path.join(data_path, "gni", gni_file)
+        )
+
+    rows += generate_weo(
+        os.path.join(data_path, "IMF_WEO_IN", "WEOApr2024all.xls"), country_df, rng
+    )
+    return rows
+
+
+def generate_weo(path, country_df, rng):
+    # UTF-16LE tab separated text like the IMF "xls" download, with every
+    # descriptive column of the real export (older parsers drop them by name),
+    # "n/a" cells, thousands separators and the footer rows the parser skips
+    weo_years = [str(year) for year in range(1980, 2030)]
+    weo_df = cross(
+        country_df[["COUNTRY", "NAMEWORKEN"]].rename(
+            columns={"COUNTRY": "ISO", "NAMEWORKEN": "Country"}
+        ),
+        pd.DataFrame({"WEO Subject Code": list(WEO_SUBJECTS)}),
+    )
+    low = weo_df["WEO Subject Code"].map(lambda s: WEO_SUBJECTS[s][0]).to_numpy()
+    high = weo_df["WEO Subject Code"].map(lambda s: WEO_SUBJECTS[s][1]).to_numpy()
+    values = (
+        low[:, None] + rng.random((len(weo_df), len(weo_years))) * (high - low)[:, None]
+    )
+    cells = pd.DataFrame(values, columns=weo_years).map(lambda v: f"{v:,.3f}")
+    cells = cells.mask(rng.random(cells.shape) < 0.02, "n/a")
+    weo_df.insert(0, "WEO Country Code", "111")
+    weo_df = weo_df[["WEO Country Code", "ISO", "WEO Subject Code", "Country"]]
+    weo_df["Subject Descriptor"] = "Subject " + weo_df["WEO Subject Code"]
+    weo_df["Subject Notes"] = "See the IMF WEO database notes"
+    weo_df["Units"] = "National currency"
+    weo_df["Scale"] = "Units"
+    weo_df["Country/Series-specific Notes"] = "Source: National Statistics Office"
+    weo_df = pd.concat([weo_df, cells], axis=1)
+    weo_df["Estimates Start After"] = rng.integers(2020, 2025, len(weo_df))
+
+    with open(path, "w", encoding="utf-16-le", newline="") as weo_file:
+        weo_df.to_csv(weo_file, sep="\t", index=False, lineterminator="\n")
+        weo_file.write("\t" * (len(weo_df.columns) - 1) + "\n")
+        weo_file.write("International Monetary Fund, World Economic Outlook Database\n")
+    return len(weo_df)
+
+
+def odata_values(text):
+    # "2020" -> [2020], "('a','b')" -> ["a", "b"]
+    values = []
+    for literal in text.strip("()").split(","):
+        literal = literal.strip()
+        if literal.startswith("'"):
+            values.append(literal[1:-1].replace("''", "'"))
+        else:
+            values.append(float(literal) if "." in literal else int(literal))
+    return values
+
+
+class ODataHandler(BaseHTTPRequestHandler):
+    # serves the generated tables the way the xMart OData API pages them:
+    # $select, $filter with eq/in, $top/$skip and $count
+    def do_GET(self):
+        url = urllib.parse.urlsplit(self.path)
+        table = url.path.strip("/")
+        params = dict(urllib.parse.parse_qsl(url.query))
+        df = self.server.query(table, params.get("$select"), params.get("$filter"))
+        top = int(params.get("$top", len(df)))
+        skip = int(params.get("$skip", 0))
+        body = '{"value":' + df.iloc[skip : skip + top].to_json(orient="records")
+        if params.get("$count") == "true":
+            body += f',"@odata.count":{len(df)}'
+        data = (body + "}").encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        return
+
+
+class ODataStub(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, data_path):
+        super().__init__(("127.0.0.1", 0), ODataHandler)
+        self.data_path = data_path
+        self.results = {}
+        self.lock = threading.Lock()
+
+    def query(self, table, select, filter):
+        # every page of a query filters the same rows, they are kept
+        key = (table, select, filter)
+        with self.lock:
+            if key not in self.results:
+                self.results[key] = self.load(table, select, filter)
+            return self.results[key]
+
+    def load(self, table, select, filter):
+        predicates = [] if filter is None else filter.split(" and ")
+        files = [
+            os.path.join(self.data_path, file)
+            for file in sorted(os.listdir(self.data_path))
+            if re.fullmatch(rf"{table}_\d{{4}}\.parquet", file)
+        ]
+        df = pd.concat([pd.read_parquet(file) for file in files], ignore_index=True)
+        for predicate in predicates:
+            column, op, text = predicate.split(" ", 2)
+            values = odata_values(text)
+            df = (
+                df[df[column] == values[0]]
+                if op == "eq"
+                else df[df[column].isin(values)]
+            )
+        if select is not None:
+            df = df[select.split(",")]
+        return df.reset_index(drop=True)
+
+
+def extract_worker(port):
+    # runs xmart_parquet.extract_from_api in its own process against the stub
+    from azure.core.credentials import AccessToken
+    from xmart_extractor import XmartExtractor
+    import run_metrics
+
+    sys.path.append(SCRIPTS_PATH)
+    import xmart_parquet
+
+    for name in ["AUTHN_APP", "AUTHN_PASSWORD", "AUTHN_TENANT"]:
+        os.environ.setdefault(name, "benchmark")
+    os.environ.setdefault("AUTHN_RESOURCE", "http://127.0.0.1")
+    xmart = XmartExtractor(max_workers=int(os.getenv("BENCH_XMART_WORKERS", "8")))
+    xmart.base_url = f"http://127.0.0.1:{port}/"
+    xmart.access_token = AccessToken("benchmark", int(time.time()) + 24 * 3600)
+    with run_metrics.stage("extract"):
+        xmart_parquet.extract_from_api(xmart, incremental=False)
+    run_metrics.write_report("xmart_parquet")
+    return 0
+
+
+def run_stage(command, cwd, log_path):
+    # wall time and peak RSS (MB) of one stage run as a child process
+    start_time = time.time()
+    with open(log_path, "a") as log_file:
+        process = subprocess.Popen(
+            command, cwd=cwd, stdout=log_file, stderr=subprocess.STDOUT
+        )
+        _, status, usage = os.wait4(process.pid, 0)
+    seconds = time.time() - start_time
+    process.returncode = os.waitstatus_to_exitcode(status)
+    if process.returncode != 0:
+        raise RuntimeError(f"{' '.join(command)} failed, see {log_path}")
+    # ru_maxrss is in KB on Linux and in bytes on macOS
+    peak_rss = usage.ru_maxrss / (1024**2 if sys.platform == "darwin" else 1024)
+    return seconds, peak_rss
+
+
+def stage_commands(stub_port):
+    python = sys.executable
+    return {
+        "extract": [python, os.path.abspath(__file__), "--extract", str(stub_port)],
+        "imf_weo_csv_parquet": [
+            python,
+            os.path.join(SCRIPTS_PATH, "imf_weo_csv_parquet.py"),
+        ],
+        "imf_weo_required_columns": [
+            python,
+            os.path.join(SCRIPTS_PATH, "imf_weo_required_columns.py"),
+        ],
+        "whdh_gold_data": [
+            python,
+            os.path.join(SCRIPTS_PATH, "whdh_gold_data.py"),
+            "--full",
+        ],
+    }
+
+
+def run_scale(scale, stages, work_path):
+    countries, years, units = parse_scale(scale)
+    pipeline_path = os.path.join(work_path, scale, "pipeline")
+    extract_path = os.path.join(work_path, scale, "extract")
+    os.makedirs(os.path.join(pipeline_path, "whdh_gold"), exist_ok=True)
+    os.makedirs(os.path.join(extract_path, "data"), exist_ok=True)
+    rows = generate(os.path.join(pipeline_path, "data"), countries, years, units)
+    print(f"{scale}: {rows} generated rows")
+
+    stub = ODataStub(os.path.join(pipeline_path, "data"))
+    threading.Thread(target=stub.serve_forever, daemon=True).start()
+    commands = stage_commands(stub.server_address[1])
+
+    results = []
+    try:
+        for stage in stages:
+            cwd = extract_path if stage == "extract" else pipeline_path
+            seconds, peak_rss = run_stage(
+                commands[stage], cwd, os.path.join(work_path, scale, f"{stage}.log")
+            )
+            print(f"--- {scale} {stage}: {seconds:.2f} seconds, {peak_rss:.0f} MB ---")
+            results.append(
+                {
+                    "stage": stage,
+                    "scale": scale,
+                    "rows": rows,
+                    "seconds": round(seconds, 3),
+                    "peak_rss_mb": round(peak_rss, 1),
+                }
+            )
+    finally:
+        stub.shutdown()
+    return results
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=SCRIPTS_PATH,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def load_results(path):
+    if not os.path.exists(path):
+        return []
+    with open(path, "r") as results_file:
+        return [json.loads(line) for line in results_file if line.strip()]
+
+
+def regressions(history, results):
+    # a stage is slower when it takes more than TOLERANCE times the median of
+    # its earlier runs at the same scale
+    slower = []
+    for result in results:
+        previous = [
+            entry["seconds"]
+            for entry in history
+            if entry["stage"] == result["stage"] and entry["scale"] == result["scale"]
+        ]
+        if len(previous) > 0 and result["seconds"] > TOLERANCE * np.median(previous):
+            slower.append((result, float(np.median(previous))))
+    return slower
+
+
+def main():
+    if "--extract" in sys.argv:
+        return extract_worker(int(sys.argv[sys.argv.index("--extract") + 1]))
+
+    stages = [s for s in os.getenv("BENCH_STAGES", ",".join(STAGES)).split(",") if s]
+    unknown = sorted(set(stages) - set(STAGES))
+    if unknown:
+        raise ValueError(f"unknown benchmark stages {unknown}")
+
+    history = load_results(RESULTS_PATH)
+    commit = git_commit()
+    recorded_at = datetime.datetime.now(datetime.timezone.utc).isoformat()
+    work_path = tempfile.mkdtemp(prefix="whdh_benchmark_")
+    results = []
+    try:
+        for scale in SCALES.split(","):
+            results += run_scale(scale, stages, work_path)
+    finally:
+        if "--keep" in sys.argv:
+            print(f"benchmark data kept in {work_path}")
+        else:
+            shutil.rmtree(work_path)
+
+    os.makedirs(os.path.dirname(RESULTS_PATH) or ".", exist_ok=True)
+    with open(RESULTS_PATH, "a") as results_file:
+        for result in results:
+            result.update({"commit": commit, "recorded_at": recorded_at})
+            results_file.write(json.dumps(result) + "\n")
+
+    slower = regressions(history, results)
+    for result, median in slower:
+        print(
+            f"REGRESSION {result['scale']} {result['stage']}: "
+            f"{result['seconds']:.2f}s vs median {median:.2f}s"
+        )
+    return 1 if slower else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,97 +1,136 @@
 import pandas as pd
-import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pv
 import os
+import re
+import sys
+
+sys.path.append(
+    os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "packages"))
+)
+import weo_store
+from cy_store import write_sorted
+from fingerprint import file_hash
+import run_metrics
+
+NUMBER_PATTERN = r"^[-+]?(\d+\.?\d*|\.\d+)([eE][-+]?\d+)?$"
+
+
+def parse_numbers(column):
+    # "1,234.5" -> 1234.5, "--" -> 0, n/a, NA and anything else that is not a
+    # number -> null, in one pass over the arrow column
+    column = pc.utf8_trim_whitespace(column)
+    column = pc.if_else(pc.equal(column, "--"), "0", column)
+    column = pc.replace_substring(column, ",", "")
+    numeric = pc.match_substring_regex(column, NUMBER_PATTERN)
+    column = pc.if_else(numeric, column, pa.scalar(None, pa.string()))
+    return pc.cast(column, pa.float64())
+
+
+def read_weo(filepath, first_year=2011, block_size=1 << 22):
+    # the WEO "xls" export is UTF-16LE tab separated text, it is decoded and
+    # parsed block by block, only ISO, subject, estimate_after and the year
+    # columns from first_year on are kept and numbers are parsed per block
+    with open(filepath, "r", encoding="utf-16-le") as f:
+        header = f.readline().rstrip("\r\n").split("\t")
+    years = [col for col in header if col.isdigit() and int(col) >= first_year]
+    keys = ["ISO", "WEO Subject Code", "Estimates Start After"]
+
+    reader = pv.open_csv(
+        filepath,
+        read_options=pv.ReadOptions(encoding="utf-16-le", block_size=block_size),
+        parse_options=pv.ParseOptions(
+            delimiter="\t", invalid_row_handler=lambda row: "skip"
+        ),
+        convert_options=pv.ConvertOptions(
+            include_columns=keys + years,
+            column_types={col: pa.string() for col in keys + years},
+            null_values=[""],
+            strings_can_be_null=True,
+        ),
+    )
+    batches = []
+    for batch in reader:
+        batch = batch.filter(pc.is_valid(batch.column("ISO")))
+        batches.append(
+            pa.RecordBatch.from_arrays(
+                [batch.column(col) for col in keys]
+                + [parse_numbers(batch.column(col)) for col in years],
+                names=["country_code", "weo_subject_code", "estimate_after"] + years,
+            )
+        )
+    return pa.Table.from_batches(batches, schema=batches[0].schema).to_pandas()
 
 
 def process_files(filename):
-    # read from file
+    # read from file, a vintage whose source file is unchanged is kept as is
     filepath = os.path.join("data/IMF_WEO_IN", filename)
-    rcy_imf_weo = pd.read_csv(filepath, delimiter="\t", encoding="utf-16-le", dtype=str)
-
-    # rename and create estimate_after
-    rcy_imf_weo.rename(
-        columns={
-            "ISO": "country_code",
-            "Estimates Start After": "estimate_after",
-            "WEO Subject Code": "weo_subject_code",
-        },
-        inplace=True,
-    )
-    rcy_imf_weo = rcy_imf_weo[rcy_imf_weo["country_code"] != ""]
-    rcy_imf_weo_estimate_after = rcy_imf_weo[
-        ["country_code", "weo_subject_code", "estimate_after"]
-    ]
-
-    # drop irrelevant columns
-    unnamed_columns = [col for col in rcy_imf_weo.columns if "Unnamed" in col]
-    drop_years = [str(year) for year in range(1980, 2011)]
-    rcy_imf_weo = rcy_imf_weo.drop(
-        columns=[
-            "WEO Country Code",
-            "Country",
-            "Subject Descriptor",
-            "Subject Notes",
-            "Country/Series-specific Notes",
-            "Units",
-            "Scale",
-            "estimate_after",
-        ]
-        + unnamed_columns
-        + drop_years
-    )
+    vintage = weo_store.vintage_of(filename)
+    sha256 = file_hash(filepath)
+    if weo_store.source_hash(vintage) == sha256:
+        print(f"{vintage} unchanged")
+        return vintage
+    rcy_imf_weo = read_weo(filepath)
+    run_metrics.add("bytes_read", os.path.getsize(filepath))
+    run_metrics.add("rows_in", len(rcy_imf_weo))
 
-    # replace NA n/a --
-    rcy_imf_weo.replace({"n/a": np.nan, "NA": np.nan, "--": "0"}, inplace=True)
-    for col in rcy_imf_weo.columns[2:]:
-        rcy_imf_weo[col] = rcy_imf_weo[col].str.replace(",", "", regex=False)
-        rcy_imf_weo[col] = pd.to_numeric(rcy_imf_weo[col], errors="coerce")
-
-    # melt and merge with estimate_after
-    rcy_imf_weo = rcy_imf_weo.melt(
-        id_vars=["country_code", "weo_subject_code"],
-        var_name="year",
-        value_name="value",
-    )
-    rcy_imf_weo["year"] = pd.to_numeric(
-        rcy_imf_weo["year"], errors="coerce", downcast="integer"
-    )
-    rcy_imf_weo = rcy_imf_weo.merge(
-        rcy_imf_weo_estimate_after,
-        on=["country_code", "weo_subject_code"],
-        how="left",
-    )
+    # estimate_after stays one value per series in a sidecar instead of being
+    # merged onto every country/year, is_an_estimate is year > estimate_after
+    estimate_after = rcy_imf_weo[["country_code", "weo_subject_code", "estimate_after"]]
+    estimate_after["estimate_after"] = pd.to_numeric(
+        estimate_after["estimate_after"], errors="coerce"
+    ).astype("Int16")
 
-    # remove estimated row
-    rcy_imf_weo["estimate_after"] = pd.to_numeric(
-        rcy_imf_weo["estimate_after"], errors="coerce", downcast="integer"
-    )
-    # rcy_imf_weo["is_an_estimate"] = (~rcy_imf_weo["estimate_after"].isna()) & (
-    #     rcy_imf_weo["year"] > rcy_imf_weo["estimate_after"]
-    # )
-    rcy_imf_weo["is_an_estimate"] = (~rcy_imf_weo["estimate_after"].isna()) & (
-        rcy_imf_weo["year"] > rcy_imf_weo["estimate_after"]
+    # transpose the year columns into rows: (country, subject) x year becomes
+    # (country, year) x subject, duplicated series are averaged and empty
+    # cells, rows and subjects are dropped and subjects are sorted as
+    # pivot_table did
+    years = [col for col in rcy_imf_weo.columns if col.isdigit()]
+    values = rcy_imf_weo.set_index(["country_code", "weo_subject_code"])[years]
+    values.columns = pd.Index(pd.to_numeric(years, downcast="integer"), name="year")
+    if values.index.has_duplicates:
+        values = values.groupby(level=["country_code", "weo_subject_code"]).mean()
+
+    # save
+    rcy_imf_weo = (
+        values.stack(future_stack=True)
+        .dropna()
+        .unstack("weo_subject_code")
+        .dropna(axis=1, how="all")
+        .sort_index(axis=1)
+        .reset_index()
     )
-    # rcy_imf_weo = rcy_imf_weo[rcy_imf_weo["is_an_estimate"]] # not sure why estimate column is needed, since filter will be performed in imf_weo_analysis.py anyway
-    rcy_imf_weo = rcy_imf_weo.drop(columns=["estimate_after", "is_an_estimate"])
-
-    # pivot and save
-    rcy_imf_weo["country_code"] = rcy_imf_weo["country_code"].astype(str)
-    rcy_imf_weo["weo_subject_code"] = rcy_imf_weo["weo_subject_code"].astype(str)
-    rcy_imf_weo = pd.pivot_table(
-        rcy_imf_weo,
-        values="value",
-        index=["country_code", "year"],
-        columns=["weo_subject_code"],
-        aggfunc="mean",
-    ).reset_index()
     rcy_imf_weo = rcy_imf_weo.sort_values(by=["country_code", "year"])
-    rcy_imf_weo.to_parquet("data/cy_imf_weo.parquet", engine="pyarrow")
-    return
+    weo_store.write_vintage(vintage, rcy_imf_weo, estimate_after, sha256)
+    run_metrics.add("rows_out", len(rcy_imf_weo))
+    run_metrics.add(
+        "bytes_written", run_metrics.path_bytes(weo_store.partition_path(vintage))
+    )
+    return vintage
 
 
 def main():
+    pd.set_option("mode.copy_on_write", True)
     pd.set_option("display.max_columns", None)
-    process_files("WEOApr2024all.xls")
+    filenames = sorted(
+        file
+        for file in os.listdir("data/IMF_WEO_IN")
+        if re.fullmatch(r"WEO[A-Z][a-z]{2}\d{4}all\.xls", file)
+    )
+    for filename in filenames:
+        with run_metrics.stage(f"weo_parse {filename}"):
+            process_files(filename)
+
+    # the latest vintage is also kept at the flat paths read downstream
+    latest = weo_store.latest_vintage()
+    write_sorted(weo_store.load_weo(latest), "data/cy_imf_weo.parquet")
+    write_sorted(
+        weo_store.load_estimate_after(latest),
+        "data/cy_imf_weo_estimate_after.parquet",
+        keys=weo_store.KEY_COLUMNS,
+    )
+    run_metrics.write_report("imf_weo_csv_parquet")
     return 0
 
 
@@ -1,69 +1,93 @@
 import os
+import sys
 import pandas as pd
 
+sys.path.append(
+    os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "packages"))
+)
+import weo_store
+from cy_store import read_cy, write_sorted
+import arrow_io
+import run_metrics
+
+# the only WEO subjects the columns below are derived from
+WEO_SUBJECTS = [
+    "GGX_NGDP",
+    "GGXONLB_NGDP",
+    "GGXCNL_NGDP",
+    "NGDPRPC",
+    "NGDPPC",
+    "NGDPDPC",
+    "NGDP_D",
+]
+
+
+def minus_interest_payments_ngdp(df):
+    # GGX_MinusInterestPayments_NGDP
+    return df["GGX_NGDP"] - (df["GGXONLB_NGDP"] - df["GGXCNL_NGDP"])
+
 
 def process_GGX_MinusInterestPayments_LCU_index(df):
+    # df is only read, the derived columns are local series so the WEO
+    # frame is shared between both indicators without being copied
     who_base_year = 2023
 
-    df["GGX_MinusInterestPayments_NGDP"] = df["GGX_NGDP"] - (
-        df["GGXONLB_NGDP"] - df["GGXCNL_NGDP"]
+    per_capita = (minus_interest_payments_ngdp(df) / 100) * df["NGDPRPC"]
+
+    base_years = df["year"] >= who_base_year
+    temp = df.loc[base_years, ["country_code", "year"]]
+    temp["GGX_MinusInterestPayments_LCU_index"] = (
+        per_capita[base_years]
+        .groupby(temp["country_code"])
+        .transform(lambda x: 100 * (x / x.iloc[0]))
     )
-    df["GGX_MinusInterestPayments_NGDPRPC"] = (
-        df["GGX_MinusInterestPayments_NGDP"] / 100
-    ) * df["NGDPRPC"]
 
-    temp = df[df["year"] >= who_base_year].copy()
-    temp["GGX_MinusInterestPayments_LCU_index"] = temp.groupby("country_code")[
-        "GGX_MinusInterestPayments_NGDPRPC"
-    ].transform(lambda x: 100 * (x / x.iloc[0]))
+    return temp
 
-    return temp[["country_code", "year", "GGX_MinusInterestPayments_LCU_index"]]
+
+def base_year_values(df, columns, base_years):
+    # each country's values of columns in every base year, broadcast back to
+    # all of its rows in one indexed lookup, as columns named f"{column}_{year}".
+    # Countries without a base year row get NaN
+    base = (
+        df.loc[df["year"].isin(base_years), ["country_code", "year"] + columns]
+        .drop_duplicates(subset=["country_code", "year"])
+        .set_index(["country_code", "year"])
+        .unstack("year")
+        .reindex(columns=pd.MultiIndex.from_product([columns, base_years]))
+    )
+    base.columns = [f"{column}_{year}" for column, year in base.columns]
+    return pd.DataFrame(
+        base.reindex(df["country_code"]).to_numpy(dtype=float),
+        index=df.index,
+        columns=base.columns,
+    )
 
 
 def process_GGX_MinusInterestPayments_ConstantUSD_percapita_rebased(df):
     # GGX_MinusInterestPayments_NGDPPC
-    df["GGX_MinusInterestPayments_NGDP"] = df["GGX_NGDP"] - (
-        df["GGXONLB_NGDP"] - df["GGXCNL_NGDP"]
-    )
-    df["GGX_MinusInterestPayments_NGDPPC"] = (
-        df["GGX_MinusInterestPayments_NGDP"] / 100
-    ) * df["NGDPPC"]
+    per_capita = (minus_interest_payments_ngdp(df) / 100) * df["NGDPPC"]
 
-    # Rebaser_Coefficient
+    # Rebase values of NGDP_D and Implied_FX
     rebase_year = 2024
-    df["NGDP_D_Rebase"] = df.apply(
-        lambda row: row["NGDP_D"] if row["year"] == rebase_year else pd.NA,
-        axis=1,
+    implied_fx = df[["country_code", "year", "NGDP_D"]].assign(
+        Implied_FX=df["NGDPDPC"] / df["NGDPPC"]
     )
-    df["NGDP_D_Rebase"] = df.groupby("country_code")["NGDP_D_Rebase"].ffill().bfill()
-    df["Rebaser_Coefficient"] = df["NGDP_D_Rebase"] / df["NGDP_D"]
+    base = base_year_values(implied_fx, ["NGDP_D", "Implied_FX"], [rebase_year])
 
-    # GGX_MinusInterestPayments_NCU_percapita_rebased
-    df["GGX_MinusInterestPayments_NCU_percapita_rebased"] = (
-        df["GGX_MinusInterestPayments_NGDPPC"] * df["Rebaser_Coefficient"]
-    )
+    # Rebaser_Coefficient
+    rebaser_coefficient = base[f"NGDP_D_{rebase_year}"] / df["NGDP_D"]
 
-    # Implied_FX_Rebase
-    df["Implied_FX"] = df["NGDPDPC"] / df["NGDPPC"]
-    df["Implied_FX_Rebase"] = df.apply(
-        lambda row: row["Implied_FX"] if row["year"] == rebase_year else pd.NA, axis=1
-    )
-    df["Implied_FX_Rebase"] = (
-        df.groupby("country_code")["Implied_FX_Rebase"].ffill().bfill()
-    )
+    # GGX_MinusInterestPayments_NCU_percapita_rebased
+    ncu_rebased = per_capita * rebaser_coefficient
 
-    # GGX_MinusInterestPayments_ConstantUSD_percapita_rebased
-    df["GGX_MinusInterestPayments_ConstantUSD_percapita_rebased"] = (
-        df["GGX_MinusInterestPayments_NCU_percapita_rebased"] * df["Implied_FX_Rebase"]
+    # GGX_MinusInterestPayments_ConstantUSD_percapita_rebased, at the
+    # Implied_FX of the rebase year
+    usd_df = df[["country_code", "year"]]
+    usd_df["GGX_MinusInterestPayments_ConstantUSD_percapita_rebased"] = (
+        ncu_rebased * base[f"Implied_FX_{rebase_year}"]
     )
-
-    return df[
-        [
-            "country_code",
-            "year",
-            "GGX_MinusInterestPayments_ConstantUSD_percapita_rebased",
-        ]
-    ]
+    return usd_df
 
 
 def process_zerodose_dtpcv1():
@@ -78,7 +102,7 @@ def process_zerodose_dtpcv1():
     temp_df = []
     # Iterate over the list of Parquet files and read each into a pandas DataFrame
     for file in parquet_files:
-        df = pd.read_parquet(file)
+        df = arrow_io.read_parquet(file)
         temp_df.append(df)
 
     ad_coverages_df = pd.concat(temp_df, ignore_index=True)
@@ -108,9 +132,22 @@ def process_zerodose_dtpcv1():
 
 
 def main():
+    with run_metrics.stage("imf_weo_required_columns"):
+        required_columns()
+    run_metrics.write_report("imf_weo_required_columns")
+
+
+def required_columns():
+    pd.set_option("mode.copy_on_write", True)
     pd.set_option("future.no_silent_downcasting", True)
     pd.set_option("display.max_columns", None)
-    cy_imf_weo = pd.read_parquet("data/cy_imf_weo.parquet")
+    # WEO_VINTAGE pins a release such as Apr2024, otherwise the latest is used
+    vintage = os.getenv("WEO_VINTAGE")
+    if vintage is None and len(weo_store.vintages()) == 0:
+        cy_imf_weo = read_cy("data/cy_imf_weo.parquet", columns=WEO_SUBJECTS)
+    else:
+        cy_imf_weo = weo_store.load_weo(vintage, columns=WEO_SUBJECTS)
+    run_metrics.add("rows_in", len(cy_imf_weo))
 
     lcu_df = process_GGX_MinusInterestPayments_LCU_index(df=cy_imf_weo)
     usd_df = process_GGX_MinusInterestPayments_ConstantUSD_percapita_rebased(
@@ -121,7 +158,9 @@ def main():
     df1 = pd.merge(lcu_df, usd_df, on=["country_code", "year"], how="outer")
     cy_ie_df = pd.merge(df1, zerodose_df, on=["country_code", "year"], how="outer")
 
-    cy_ie_df.to_parquet(f"data/cy_ie.parquet", engine="pyarrow")
+    write_sorted(cy_ie_df, "data/cy_ie.parquet")
+    run_metrics.add("rows_out", len(cy_ie_df))
+    run_metrics.add("bytes_written", run_metrics.path_bytes("data/cy_ie.parquet"))
 
 
 if __name__ == "__main__":
@@ -1,280 +1,583 @@
 import sys
 import os
 import json
+import functools
 import time
-import math
 import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
 
-sys.path.append(
-    os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "packages"))
+PACKAGES_PATH = os.path.abspath(
+    os.path.join(os.path.dirname(__file__), "..", "packages")
 )
+sys.path.append(PACKAGES_PATH)
+from frame_cache import FrameCache
+from task_graph import run_graph
+from fingerprint import file_hash
+from gold_json import write_gold_json
+from indicators import ratio_indicators
+import run_metrics
+from cy_store import read_cy, write_sorted
+import arrow_io
+
+# raw tables are shared by every builder, each one is read once per run
+raw_cache = FrameCache(max_bytes=int(os.getenv("WHDH_CACHE_BYTES", str(2 * 1024**3))))
+
+BUILD_MANIFEST_PATH = os.path.join("data", "gold_build_manifest.json")
+
+# country/year fact table the chart builders read from
+FACTS_PATH = os.path.join("data", "cy_facts.parquet")
+FACTS_IPC_PATH = os.path.join("data", "cy_facts.arrow")
+FACT_KEYS = ["country_code", "country", "WHO_region", "GAVI", "year"]
+# every distinct country/region/GAVI label of the MT_AD_IA2030 rows per type
+LABELS_PATH = os.path.join("data", "cy_labels.parquet")
+LABELS = ["country", "WHO_region", "GAVI"]
+AD_TYPES = ["TEV", "TERI", "GEV", "GERI"]
+FINANCE_CODES = [
+    "LP",
+    "NGDPD",
+    "CHE_USD",
+    "PHC_USD",
+    "GGHED_USD",
+    "EXT_USD",
+    "GGHED_GGE",
+]
+
+
+def expenditure_ratios(total, government):
+    # C-J of one expenditure type, e.g. TERI with its government part GERI
+    return {
+        f"C_{total}": (total, "surviving_infant"),
+        f"D_{total}": (total, "LP"),
+        f"E_{total}": (government, total),
+        f"F_{total}": (total, "NGDPD"),
+        f"G_{total}": (total, "CHE_USD"),
+        f"H_{total}": (total, "PHC_USD"),
+        f"I_{total}": (total, "GGHED_USD"),
+        f"J_{total}": (total, "EXT_USD"),
+    }
 
 
-def parquet_to_df(prefix):
+# gghed_gge indicators, name: (numerator, denominator) over fact table
+# columns. A new ratio is one more entry here
+GGHED_RATIOS = {
+    "B": ("TEV", "TERI"),
+    **expenditure_ratios("TERI", "GERI"),
+    **expenditure_ratios("TEV", "GEV"),
+}
+
+# WHDH_GOLD_LAYOUT: nested ({entity: {year: value}}) or columnar ({"years": [...],
+# "values": {entity: [...]}}), WHDH_GOLD_COMPRESS: e.g. "gzip,br" to also write
+# pre-compressed siblings of every json file
+GOLD_LAYOUT = os.getenv("WHDH_GOLD_LAYOUT", "nested")
+GOLD_COMPRESS = [c for c in os.getenv("WHDH_GOLD_COMPRESS", "").split(",") if c]
+
+# defined at module level so builders running in worker processes see it
+update_names = {
+    "Gavi low income": "Low Income",
+    "non-Gavi middle income": "MIC (GAVI ineligible)",
+    "High income": "High Income",
+    "Gavi low-middle income": "MIC (GAVI eligible)",
+    "AFRO": "African Region",
+    "AMRO": "Americas Region",
+    "EMRO": "Eastern Mediterranean Region",
+    "EURO": "European Region",
+    "SEARO": "South-East Asian Region",
+    "WPRO": "Western Pacific Region",
+    "AFR": "African Region",
+    "AMR": "Americas Region",
+    "EMR": "Eastern Mediterranean Region",
+    "EUR": "European Region",
+    "SEAR": "South-East Asian Region",
+    "WPR": "Western Pacific Region",
+}
+
+
+def dimension_dtypes(labels_df):
+    # one categorical dtype per key column of labels_df with sorted raw
+    # categories, regions and GAVI groups are relabelled with update_names on
+    # their categories only: {column: (raw dtype, relabelled dtype, lookup)},
+    # lookup maps the raw codes to the relabelled ones
+    dims = {}
+    for column in ["country_code"] + LABELS:
+        raw = pd.CategoricalDtype(sorted(labels_df[column].dropna().unique()))
+        labels = [update_names.get(label, label) for label in raw.categories]
+        dtype = pd.CategoricalDtype(sorted(set(labels)))
+        lookup = np.append(dtype.categories.get_indexer(labels), -1)
+        dims[column] = (raw, dtype, lookup)
+    return dims
+
+
+@functools.lru_cache(maxsize=None)
+def dimensions():
+    # shared country/region/GAVI reference, loaded once per process from the
+    # labels the fact stage wrote
+    return dimension_dtypes(parquet_file_to_df(LABELS_PATH))
+
+
+def dimension_codes(df):
+    # key columns of a fact frame become codes of the shared dimensions, so
+    # merges and group-bys run on integers. Values outside the reference
+    # become NaN, code -1 stays -1 through the lookup
+    for column, (raw, dtype, lookup) in dimensions().items():
+        if column in df.columns:
+            codes = pd.Categorical(df[column], dtype=raw).codes
+            df[column] = pd.Categorical.from_codes(lookup[codes], dtype=dtype)
+    return df
+
+
+def partition_year(file):
+    # yearly files are named {TABLE}_{YEAR}.parquet
+    year = os.path.basename(file)[: -len(".parquet")].rsplit("_", 1)[-1]
+    return int(year) if year.isdigit() else None
+
+
+def year_partition_matches(year, filters):
+    # drop whole yearly files that cannot satisfy a YEAR filter
+    if year is None or filters is None:
+        return True
+    compare = {
+        "==": lambda a, b: a == b,
+        "=": lambda a, b: a == b,
+        "!=": lambda a, b: a != b,
+        "<": lambda a, b: a < b,
+        "<=": lambda a, b: a <= b,
+        ">": lambda a, b: a > b,
+        ">=": lambda a, b: a >= b,
+        "in": lambda a, b: a in b,
+        "not in": lambda a, b: a not in b,
+    }
+    return all(
+        compare[op](year, value)
+        for column, op, value in filters
+        if column == "YEAR" and op in compare
+    )
 
+
+def prefix_files(prefix):
     directory_path = "data"
-    parquet_files = [
+    return [
         os.path.join(directory_path, file)
-        for file in os.listdir(directory_path)
+        for file in sorted(os.listdir(directory_path))
         if file.startswith(prefix) and file.endswith(".parquet")
     ]
 
-    temp_df = []
-    # Iterate over the list of Parquet files and read each into a pandas DataFrame
-    for file in parquet_files:
-        df = pd.read_parquet(file)
-        temp_df.append(df)
 
-    concat_df = pd.concat(temp_df, ignore_index=True)
-    return concat_df
+def parquet_to_df(prefix, columns=None, filters=None):
+    # columns: list of columns to read, filters: list of (column, op, value)
+    # tuples that must all hold, as in pd.read_parquet. The yearly files are
+    # scanned as one pyarrow dataset, so only the requested columns and the
+    # row groups whose statistics can match are read
+
+    parquet_files = [
+        file
+        for file in prefix_files(prefix)
+        if year_partition_matches(partition_year(file), filters)
+    ]
+
+    def load():
+        schema = pa.unify_schemas(
+            [pq.read_schema(file) for file in parquet_files],
+            promote_options="permissive",
+        ).remove_metadata()
+        dataset = ds.dataset(
+            parquet_files,
+            schema=schema,
+            format="parquet",
+            filesystem=arrow_io.filesystem(),
+        )
+        table = dataset.to_table(
+            columns=columns,
+            filter=None if filters is None else pq.filters_to_expression(filters),
+        )
+        run_metrics.add("bytes_read", sum(os.path.getsize(f) for f in parquet_files))
+        run_metrics.add("rows_in", table.num_rows)
+        return arrow_io.to_frame(table)
+
+    key = (prefix, None if columns is None else tuple(columns), repr(filters))
+    return raw_cache.load(key, parquet_files, load)
+
+
+def parquet_file_to_df(path):
+    def load():
+        run_metrics.add("bytes_read", os.path.getsize(path))
+        return arrow_io.read_parquet(path)
+
+    return raw_cache.load(path, [path], load)
 
 
 def nan_or_round(val, multiply100=False, round_val=2):
-    return (
-        np.nan
-        if math.isnan(val)
-        else round(val * (100 if multiply100 else 1), round_val)
+    # vectorized round() over a frame, NaN stays NaN. np.round rounds the
+    # scaled binary value and can land on the other side of a decimal tie
+    # such as 39.095, those few near ties are rounded again with round()
+    scaled = val * (100 if multiply100 else 1)
+    values = np.array(scaled, dtype=float)
+    rounded = np.round(values, round_val)
+    shifted = values * 10**round_val
+    near_tie = np.abs(shifted - np.floor(shifted) - 0.5) < 1e-6
+    rounded[near_tie] = [round(v, round_val) for v in values[near_tie].tolist()]
+    return pd.DataFrame(rounded, index=scaled.index, columns=scaled.columns)
+
+
+def comparator_values(df, levels, column_name, weight=None, summed=False):
+    # grouping sets: one group-by over every level and year at once gives the
+    # weighted sums, weights and row counts, each level is then rolled up
+    # from those partial rows instead of scanning df again. weight: column of
+    # row weights, e.g. surviving_infant, rows without a weight count as 0.
+    # Without weights every row counts once, the plain mean. summed:
+    # column_name already holds the sum over weight rows, e.g. the sum of a
+    # value over the raw rows a fact row stands for and their count.
+    # Returns {level: (entity x year means, which cells had rows)}
+    values = df[column_name].astype(float)
+    weights = 1.0 if weight is None else df[weight].astype(float).fillna(0)
+    parts = df[levels + ["year"]].assign(
+        total=(values if summed else values * weights).fillna(0),
+        weight=values.notna() * weights,
+        size=1,
     )
+    partial = parts.groupby(levels + ["year"], observed=True, dropna=False).sum()
+
+    rollups = {}
+    for level in levels:
+        stats = partial.groupby(level=[level, "year"], observed=True).sum()
+        stats = stats.unstack("year")
+        rollups[level] = (
+            stats["total"] / stats["weight"],
+            stats["size"].fillna(0) > 0,
+        )
+    return rollups
 
 
 def process_comparator_country_data(
-    df: pd.DataFrame, column_name: str, filename: str, years: list
+    df: pd.DataFrame,
+    column_name: str,
+    filename: str,
+    years: list,
+    round_val=2,
+    weight=None,
+    summed=False,
 ):
-    ### WHO REGION COMPARATOR ###
-    comparator_df = (
-        df.sort_values(["year"], ascending=True)
-        .groupby(["WHO_region", "year"])[column_name]
-        .mean()
+    rollups = comparator_values(
+        df, ["WHO_region", "GAVI", "country"], column_name, weight, summed
     )
-    comparator_dict = {}
-    for (region, year), col in comparator_df.items():
-        if region not in comparator_dict:
-            comparator_dict[region] = {}
-        if year in years:
-            comparator_dict[region][year] = nan_or_round(col)
-    # comparator_json_str = json.dumps(comparator_dict, indent=4)
-    with open(os.path.join("whdh_gold", f"{filename}_region.json"), "w") as json_file:
-        json.dump(comparator_dict, json_file, indent=4)
-
-    ### GAVI COMPARATOR ###
-    comparator_df = (
-        df.sort_values(["year"], ascending=True)
-        .groupby(["GAVI", "year"])[column_name]
-        .mean()
-    )
-    comparator_dict = {}
-    for (gavi, year), col in comparator_df.items():
-        if gavi not in comparator_dict:
-            comparator_dict[gavi] = {}
-        if year in years:
-            comparator_dict[gavi][year] = nan_or_round(col)
-    # comparator_json_str = json.dumps(comparator_dict, indent=4)
-    with open(os.path.join("whdh_gold", f"{filename}_gavi.json"), "w") as json_file:
-        json.dump(comparator_dict, json_file, indent=4)
+
+    ### WHO REGION AND GAVI COMPARATORS ###
+    # only the years that have rows, in year order
+    for level, suffix in [("WHO_region", "region"), ("GAVI", "gavi")]:
+        values, present = rollups[level]
+        values = nan_or_round(values, round_val=round_val)
+        in_range = sorted(year for year in values.columns if year in years)
+        run_metrics.add("rows_out", len(values))
+        write_gold_json(
+            os.path.join("whdh_gold", f"{filename}_{suffix}.json"),
+            values[in_range],
+            present[in_range],
+            round_val=round_val,
+            layout=GOLD_LAYOUT,
+            compress=GOLD_COMPRESS,
+        )
 
     ### COUNTRY ###
-    country_df = (
-        df.sort_values(["year"], ascending=True)
-        .groupby(["country", "year"])[column_name]
-        .mean()
+    # padded to every year in years, null where a country has no value
+    values, _ = rollups["country"]
+    run_metrics.add("rows_out", len(values))
+    write_gold_json(
+        os.path.join("whdh_gold", f"{filename}_country.json"),
+        nan_or_round(values, round_val=round_val).reindex(columns=years),
+        round_val=round_val,
+        layout=GOLD_LAYOUT,
+        compress=GOLD_COMPRESS,
     )
 
-    default_dict = {}
-    for year in years:
-        default_dict[year] = np.nan
-
-    country_dict = {}
-    for (country, year), col in country_df.items():
-        if country not in country_dict:
-            country_dict[country] = (
-                default_dict.copy()
-            )  # need copy() or else all country share the same dict
-        if year in years:
-            country_dict[country][year] = nan_or_round(col)
-    # country_json_str = json.dumps(country_dict, indent=4)
-    with open(os.path.join("whdh_gold", f"{filename}_country.json"), "w") as json_file:
-        json.dump(country_dict, json_file, indent=4)
 
-
-def vaccine_spent_process():
-    ad_coverages_df = parquet_to_df("MT_AD_IA2030")
-    ad_coverages_df = (
-        ad_coverages_df[
-            (ad_coverages_df["TYPE"] == "TEV") | (ad_coverages_df["TYPE"] == "TERI")
-        ]
-        .rename(
-            columns={
-                "COUNTRY": "country_code",
-                "NAMEWORKEN": "country",
-                "WHOREGIONC": "WHO_region",
-                "GAVI_INCOME_STATUS": "GAVI",
-                "YEAR": "year",
-                "TYPE": "vaccine",
-                "VALUE_TRANSFORMED": "expenditure",
-            }
-        )
-        .loc[
-            :,
-            [
-                "country_code",
-                "country",
-                "WHO_region",
-                "GAVI",
-                "year",
-                "vaccine",
-                "expenditure",
-            ],
-        ]
-    )
-    ref_pop_df = parquet_to_df("REF_POPULATION")
-    ref_pop_df = (
-        ref_pop_df[
-            (ref_pop_df["POP_SOURCE_FK"] == "UNPD2022")
-            & (ref_pop_df["GENDER_FK"] == "BOTH")
-            & (ref_pop_df["YEAR"] > 2010)
-            & (ref_pop_df["POP_TYPE_FK"] == "SURVIVING_INFANT")
-        ]
-        .loc[:, ["COUNTRY_FK", "YEAR", "VALUE"]]
-        .rename(
-            columns={
-                "COUNTRY_FK": "country_code",
-                "YEAR": "year",
-                "VALUE": "infant",
-            }
-        )
+def country_year_facts_process():
+    # one wide row per country/year with every value the charts read, the
+    # raw tables are filtered, joined and pivoted here once and the builders
+    # read slices of data/cy_facts.parquet. Key columns keep their raw labels
+    ad_df = parquet_to_df(
+        "MT_AD_IA2030",
+        columns=[
+            "COUNTRY",
+            "NAMEWORKEN",
+            "WHOREGIONC",
+            "GAVI_INCOME_STATUS",
+            "YEAR",
+            "TYPE",
+            "VALUE_TRANSFORMED",
+        ],
+    ).rename(
+        columns={
+            "COUNTRY": "country_code",
+            "NAMEWORKEN": "country",
+            "WHOREGIONC": "WHO_region",
+            "GAVI_INCOME_STATUS": "GAVI",
+            "YEAR": "year",
+            "TYPE": "vaccine",
+            "VALUE_TRANSFORMED": "expenditure",
+        }
     )
-    immune_exp_df = pd.merge(
-        ad_coverages_df, ref_pop_df, on=["country_code", "year"], how="left"
+    keys = ["country_code", "year"]
+    labels_df = ad_df[["country_code"] + LABELS + ["vaccine"]].drop_duplicates()
+    write_sorted(labels_df, LABELS_PATH, keys=["country_code"] + LABELS)
+    run_metrics.add("bytes_written", os.path.getsize(LABELS_PATH))
+
+    # every table is joined and grouped on codes: of the raw country codes
+    # and names of MT_AD_IA2030, rows of other countries are dropped, and of
+    # the types
+    raw = {column: dims[0] for column, dims in dimension_dtypes(labels_df).items()}
+
+    def coded(df, column="country_code"):
+        df[column] = pd.Categorical(df[column], dtype=raw[column])
+        return df[df[column].notna()]
+
+    for column in ["country_code"] + LABELS:
+        ad_df[column] = pd.Categorical(ad_df[column], dtype=raw[column])
+    ad_df["vaccine"] = ad_df["vaccine"].astype("category")
+
+    # labels of a country/year are those of its first row
+    facts = ad_df.groupby(keys, observed=True).agg(
+        country=("country", "first"),
+        WHO_region=("WHO_region", "first"),
+        GAVI=("GAVI", "first"),
+        ad_rows=("vaccine", "size"),
     )
-    immune_exp_df["expenditure_per_infant"] = (
-        immune_exp_df["expenditure"] / immune_exp_df["infant"]
+
+    # TEV/TERI/GEV/GERI expenditure, and how many rows reported each of them
+    expenditure = (
+        ad_df[ad_df["vaccine"].isin(AD_TYPES)]
+        .groupby(keys + ["vaccine"], observed=True)["expenditure"]
+        .agg(["mean", "size"])
+        .unstack("vaccine")
     )
-    immune_exp_df = (
-        immune_exp_df.astype({"year": int})
-        .replace(update_names.keys(), update_names.values())
-        .round(3)
+    facts = facts.join(expenditure["mean"].reindex(columns=AD_TYPES))
+    facts = facts.join(
+        expenditure["size"].reindex(columns=AD_TYPES).add_suffix("_rows")
     )
 
-    dimension_df = immune_exp_df[
-        ["country", "country_code", "WHO_region", "GAVI"]
-    ].drop_duplicates()
-    pivot_df = pd.pivot_table(
-        immune_exp_df,
-        values="expenditure_per_infant",
-        index=["country", "year"],
-        columns="vaccine",
-    ).reset_index()
-    immune_exp_df = pd.merge(dimension_df, pivot_df, on=["country"])
-    immune_exp_df = immune_exp_df[
-        (immune_exp_df["TEV"] != 0) & (immune_exp_df["TERI"] != 0)
-    ]
-
-    # merge gni
-    current_gni_df = pd.read_csv("data/gni/current_gni.csv")[
-        ["country_code", "year", "current_gni_usd"]
-    ].astype({"year": int})
-    constant_gni_df = pd.read_csv("data/gni/constant_gni_2015.csv")[
-        ["country_code", "year", "constant_gni_2015_usd"]
-    ].astype({"year": int})
-    immune_exp_df = pd.merge(
-        immune_exp_df, current_gni_df, on=["country_code", "year"], how="left"
+    # fin_sus averages GEV/TEV over every TEV row paired with every GEV row of
+    # a country/year, in percent of the ratio rounded to 4 decimals. The sum
+    # and count of the pairs are kept, so the comparators average pairs too
+    pairs = pd.merge(
+        ad_df.loc[ad_df["vaccine"] == "TEV", keys + ["expenditure"]],
+        ad_df.loc[ad_df["vaccine"] == "GEV", keys + ["expenditure"]],
+        on=keys,
+        suffixes=("_tev", "_gev"),
     )
-    immune_exp_df = pd.merge(
-        immune_exp_df, constant_gni_df, on=["country_code", "year"], how="left"
+    share = (pairs["expenditure_gev"] / pairs["expenditure_tev"]).astype(float)
+    pairs["gev/tev"] = share.replace([np.inf, -np.inf], 0).round(4) * 100
+    facts = facts.join(
+        pairs.groupby(keys, observed=True)["gev/tev"]
+        .agg(["sum", "count"])
+        .rename(columns={"sum": "gev/tev_sum", "count": "gev/tev_pairs"})
     )
 
-    years = [y for y in range(2018, 2024)]
-    process_comparator_country_data(immune_exp_df, "TEV", "vaccine_spent", years)
-    return
-
-
-def risk_opportunity_process():
-    ad_coverages_df = parquet_to_df("MT_AD_IA2030")
-    ad_coverages_df = ad_coverages_df.rename(
+    # LCU/USD, zero-dose and DTPCV1 cover years without financing rows, those
+    # rows take the dimension labels of the country's nearest year
+    cy_ie_path = os.path.join("data", "cy_ie.parquet")
+    cy_ie_df = read_cy(
+        cy_ie_path,
+        countries=facts.index.get_level_values("country_code").unique(),
+        columns=[
+            "GGX_MinusInterestPayments_LCU_index",
+            "GGX_MinusInterestPayments_ConstantUSD_percapita_rebased",
+            "zerodose",
+            "DTPCV1",
+        ],
+    )
+    run_metrics.add("bytes_read", os.path.getsize(cy_ie_path))
+    cy_ie_df = coded(cy_ie_df)
+    cy_ie_df = cy_ie_df.rename(
         columns={
-            "COUNTRY": "country_code",
-            "NAMEWORKEN": "country",
-            "WHOREGIONC": "WHO_region",
-            "GAVI_INCOME_STATUS": "GAVI",
-            "YEAR": "year",
+            "GGX_MinusInterestPayments_LCU_index": "LCU",
+            "GGX_MinusInterestPayments_ConstantUSD_percapita_rebased": "USD",
         }
-    ).loc[
-        :,
-        ["country_code", "country", "WHO_region", "GAVI", "year"],
-    ]
-    bop_df = parquet_to_df("V_AD_COV_BOP")
-    bop_df = bop_df.rename(
+    )
+    facts = facts.join(
+        cy_ie_df.set_index(keys)[["LCU", "USD", "zerodose", "DTPCV1"]], how="outer"
+    ).sort_index()
+    for fill in ["ffill", "bfill"]:
+        by_country = facts.groupby(level="country_code", observed=True)[LABELS]
+        facts[LABELS] = getattr(by_country, fill)()
+    counts = ["ad_rows", "gev/tev_pairs"] + [f"{vaccine}_rows" for vaccine in AD_TYPES]
+    facts[counts] = facts[counts].fillna(0).astype(int)
+
+    ref_pop_df = parquet_to_df(
+        "REF_POPULATION",
+        columns=["COUNTRY_FK", "YEAR", "VALUE"],
+        filters=[
+            ("POP_SOURCE_FK", "==", "UNPD2022"),
+            ("GENDER_FK", "==", "BOTH"),
+            ("YEAR", ">", 2010),
+            ("POP_TYPE_FK", "==", "SURVIVING_INFANT"),
+        ],
+    )
+    ref_pop_df = ref_pop_df.rename(
         columns={
-            "NAME": "country",
+            "COUNTRY_FK": "country_code",
             "YEAR": "year",
+            "VALUE": "surviving_infant",
         }
-    ).loc[:, ["country", "year", "BOP"]]
-    c_ie_df = pd.read_parquet(os.path.join("data", "cy_ie.parquet"))
-    c_ie_df = (
-        c_ie_df[c_ie_df["year"] == 2024]
-        .rename(columns={"GGX_MinusInterestPayments_LCU_index": "LCU"})
-        .loc[:, ["country_code", "year", "LCU"]]
+    )
+    ref_pop_df = coded(ref_pop_df)
+    facts = facts.join(
+        ref_pop_df.groupby(keys, observed=True)[["surviving_infant"]].mean()
     )
 
-    # merge df
-    risk_opportunity_df = pd.merge(
-        ad_coverages_df, bop_df, on=["country", "year"], how="left"
+    # vaccine_spent averages the ratio of every TEV/TERI row to every
+    # surviving infant row of its country/year, each rounded to 3 decimals
+    per_infant = pd.merge(
+        ad_df.loc[
+            ad_df["vaccine"].isin(["TEV", "TERI"]), keys + ["vaccine", "expenditure"]
+        ],
+        ref_pop_df[keys + ["surviving_infant"]],
+        on=keys,
+        how="left",
     )
-    risk_opportunity_df = pd.merge(
-        risk_opportunity_df, c_ie_df, on=["country_code", "year"], how="left"
+    per_infant["per_infant"] = (
+        (per_infant["expenditure"] / per_infant["surviving_infant"])
+        .astype(float)
+        .round(3)
+    )
+    facts = facts.join(
+        per_infant.groupby(keys + ["vaccine"], observed=True)["per_infant"]
+        .mean()
+        .unstack("vaccine")
+        .reindex(columns=["TEV", "TERI"])
+        .add_suffix("_per_infant")
     )
 
-    risk_opportunity_df = risk_opportunity_df.groupby(["country", "year"]).filter(
-        lambda x: len(x) > 1
+    ref_finance_df = parquet_to_df(
+        "REF_FINANCING",
+        columns=["COUNTRY", "YEAR", "INDCODE", "VALUE"],
+        filters=[("INDCODE", "in", FINANCE_CODES)],
     )
-    risk_opportunity_df = (
-        risk_opportunity_df.astype({"year": int})
-        .replace(update_names.keys(), update_names.values())
-        .round(3)
+    ref_finance_df = ref_finance_df.rename(
+        columns={
+            "COUNTRY": "country_code",
+            "YEAR": "year",
+            "VALUE": "value",
+            "INDCODE": "code",
+        }
+    )
+    ref_finance_df = coded(ref_finance_df)
+    facts = facts.join(
+        ref_finance_df.groupby(keys + ["code"], observed=True)["value"]
+        .mean()
+        .unstack("code")
+        .reindex(columns=FINANCE_CODES)
     )
 
-    years = [y for y in range(2018, 2024)]  #! year should be made flexible
-    process_comparator_country_data(risk_opportunity_df, "BOP", "bop", years)
+    for gni_file, gni_column in [
+        ("current_gni.csv", "current_gni_usd"),
+        ("constant_gni_2015.csv", "constant_gni_2015_usd"),
+    ]:
+        gni_df = pd.read_csv(os.path.join("data", "gni", gni_file))[
+            ["country_code", "year", gni_column]
+        ].astype({"year": int})
+        gni_df = coded(gni_df)
+        facts = facts.join(gni_df.groupby(keys, observed=True)[[gni_column]].mean())
+
+    # BOP is published per country name
+    bop_df = parquet_to_df("V_AD_COV_BOP", columns=["NAME", "YEAR", "BOP"])
+    bop_df = coded(
+        bop_df.rename(columns={"NAME": "country", "YEAR": "year"}), "country"
+    )
+    facts = pd.merge(
+        facts.reset_index(),
+        bop_df.groupby(["country", "year"], observed=True, as_index=False)[
+            "BOP"
+        ].mean(),
+        on=["country", "year"],
+        how="left",
+    )
+
+    write_sorted(facts, FACTS_PATH)
+    if arrow_io.MEMORY_MAP:
+        arrow_io.write_ipc(pq.read_table(FACTS_PATH), FACTS_IPC_PATH)
+    run_metrics.add("rows_out", len(facts))
+    run_metrics.add("bytes_written", os.path.getsize(FACTS_PATH))
     return
 
 
-def fiscal_distribution_process():
-    country_df = parquet_to_df("MT_AD_IA2030")
-    country_df = (
-        country_df.rename(
-            columns={
-                "COUNTRY": "country_code",
-                "NAMEWORKEN": "country",
-                "WHOREGIONC": "WHO_region",
-                "GAVI_INCOME_STATUS": "GAVI",
-            }
-        )
-        .loc[
-            :,
-            ["country_code", "country", "WHO_region", "GAVI"],
-        ]
-        .drop_duplicates()
-    )
-    cy_ie_df = pd.read_parquet(os.path.join("data", "cy_ie.parquet"))
-    cy_ie_df = cy_ie_df.rename(
-        columns={
-            "GGX_MinusInterestPayments_LCU_index": "LCU",
-            "GGX_MinusInterestPayments_ConstantUSD_percapita_rebased": "USD",
-        }
-    ).loc[
-        :,
-        ["country_code", "year", "LCU", "USD"],
+def read_facts(columns):
+    # slice of the fact table with the shared dimension keys
+    if arrow_io.MEMORY_MAP:
+        # every builder maps the same IPC file instead of decoding its own copy
+        facts = arrow_io.read_ipc(FACTS_IPC_PATH)
+    else:
+        facts = parquet_file_to_df(FACTS_PATH)
+    run_metrics.add("rows_in", len(facts))
+    # a lazy copy under copy-on-write, the builders only add or replace
+    # whole columns of it
+    return dimension_codes(facts[FACT_KEYS + columns])
+
+
+def every_label(df, types=None, relabelled=True):
+    # the labels of df replaced by every label the country's MT_AD_IA2030
+    # rows (of types) carried in any year, so a country/year counts in each
+    # region and GAVI group the country ever belonged to. relabelled: one row
+    # per distinct label after update_names, else one per raw label and e.g.
+    # AFR and AFRO count twice
+    labels_df = parquet_file_to_df(LABELS_PATH)
+    if types is not None:
+        labels_df = labels_df[labels_df["vaccine"].isin(types)]
+    labels_df = dimension_codes(labels_df[["country_code"] + LABELS].drop_duplicates())
+    if relabelled:
+        labels_df = labels_df.drop_duplicates()
+    if labels_df["country_code"].duplicated().any():
+        return pd.merge(df.drop(columns=LABELS), labels_df, on="country_code")
+
+    # one label per country, only the label columns are replaced
+    labels_df = labels_df.set_index("country_code")
+    known = df["country_code"].isin(labels_df.index)
+    if not known.all():
+        df = df[known]
+    for column in LABELS:
+        df[column] = labels_df[column].reindex(df["country_code"]).array
+    return df
+
+
+def vaccine_spent_process():
+    columns = ["TEV_per_infant", "TERI_per_infant"]
+    immune_exp_df = read_facts(columns)
+    for column in columns:
+        # numpy floats, so missing ratios are NaN (!= 0) on Arrow backed
+        # frames as well
+        immune_exp_df[column] = immune_exp_df[column].astype(float)
+    immune_exp_df = immune_exp_df[
+        immune_exp_df[columns].notna().any(axis=1)
+        & (immune_exp_df["TEV_per_infant"] != 0)
+        & (immune_exp_df["TERI_per_infant"] != 0)
     ]
+    immune_exp_df = every_label(immune_exp_df, types=["TEV", "TERI"])
 
-    fiscal_distribution_df = pd.merge(
-        country_df, cy_ie_df, on=["country_code"], how="left"
+    years = [y for y in range(2018, 2024)]
+    process_comparator_country_data(
+        immune_exp_df, "TEV_per_infant", "vaccine_spent", years
     )
-    fiscal_distribution_df = (
-        fiscal_distribution_df.astype({"year": int})
-        .replace(update_names.keys(), update_names.values())
-        .round(3)
+    return
+
+
+def risk_opportunity_process():
+    risk_opportunity_df = read_facts(["ad_rows", "BOP"])
+    risk_opportunity_df = risk_opportunity_df[risk_opportunity_df["ad_rows"] > 1]
+    risk_opportunity_df["BOP"] = risk_opportunity_df["BOP"].round(3)
+
+    # region and GAVI means count a country once per MT_AD_IA2030 row
+    years = [y for y in range(2018, 2024)]  #! year should be made flexible
+    process_comparator_country_data(
+        risk_opportunity_df, "BOP", "bop", years, weight="ad_rows"
     )
+    return
+
+
+def fiscal_distribution_process():
+    fiscal_distribution_df = read_facts(["LCU", "USD"])
+    for column in ["LCU", "USD"]:
+        fiscal_distribution_df[column] = fiscal_distribution_df[column].round(3)
+    fiscal_distribution_df = every_label(fiscal_distribution_df, relabelled=False)
 
     threshold_middle = 100
     threshold_width = 5
@@ -290,6 +593,8 @@ def fiscal_distribution_process():
         & (fiscal_distribution_df["LCU"] <= threshold_3),
         fiscal_distribution_df["LCU"] > threshold_3,
     ]
+    # Arrow backed comparisons are null where the value is, isna() takes those
+    conditions = [c.to_numpy(dtype=bool, na_value=False) for c in conditions]
     fiscal_distribution_df["group"] = np.select(conditions, [0, 1, 3, 5], default=5)
 
     years = [y for y in range(2023, 2030)]  #! year should be made flexible
@@ -298,243 +603,217 @@ def fiscal_distribution_process():
 
 
 def gghed_gge_process():
-    ad_coverages_df = parquet_to_df("MT_AD_IA2030")
-    ad_coverages_df = (
-        ad_coverages_df[ad_coverages_df["TYPE"].isin(["TERI", "TEV", "GERI", "GEV"])]
-        .rename(
-            columns={
-                "COUNTRY": "country_code",
-                "NAMEWORKEN": "country",
-                "WHOREGIONC": "WHO_region",
-                "GAVI_INCOME_STATUS": "GAVI",
-                "YEAR": "year",
-                "TYPE": "vaccine",
-                "VALUE_TRANSFORMED": "expenditure",
-            }
-        )
-        .loc[
-            :,
-            [
-                "country_code",
-                "country",
-                "WHO_region",
-                "GAVI",
-                "year",
-                "vaccine",
-                "expenditure",
-            ],
-        ]
-    )
-    ref_pop_df = parquet_to_df("REF_POPULATION")
-    ref_pop_df = (
-        ref_pop_df[
-            (ref_pop_df["POP_SOURCE_FK"] == "UNPD2022")
-            & (ref_pop_df["GENDER_FK"] == "BOTH")
-            & (ref_pop_df["YEAR"] > 2010)
-            & (ref_pop_df["POP_TYPE_FK"] == "SURVIVING_INFANT")
-        ]
-        .loc[:, ["COUNTRY_FK", "YEAR", "VALUE"]]
-        .rename(
-            columns={
-                "COUNTRY_FK": "country_code",
-                "YEAR": "year",
-                "VALUE": "surviving_infant",
-            }
-        )
-    )
-    ref_finance_df = parquet_to_df("REF_FINANCING")
-    ref_finance_df = (
-        ref_finance_df[
-            ref_finance_df["INDCODE"].isin(
-                [
-                    "LP",
-                    "NGDPD",
-                    "CHE_USD",
-                    "PHC_USD",
-                    "GGHED_USD",
-                    "EXT_USD",
-                    "GGHED_GGE",
-                ]
-            )
-        ]
-        .loc[:, ["COUNTRY", "YEAR", "INDCODE", "VALUE"]]
-        .rename(
-            columns={
-                "COUNTRY": "country_code",
-                "YEAR": "year",
-                "VALUE": "value",
-                "INDCODE": "code",
-            }
-        )
-    )
-
-    df = pd.merge(ad_coverages_df, ref_pop_df, on=["country_code", "year"], how="left")
-    df = pd.merge(df, ref_finance_df, on=["country_code", "year"], how="left")
-    df = (
-        df.astype({"year": int})
-        .replace(update_names.keys(), update_names.values())
-        .round(3)
-    )
-
-    pivot_df_1 = (
-        pd.pivot_table(df, values="value", index=["country", "year"], columns="code")
-        .fillna(0)
-        .reset_index()
-    )
-    pivot_df_2 = (
-        pd.pivot_table(
-            df, values="expenditure", index=["country", "year"], columns="vaccine"
-        )
-        .fillna(0)
-        .reset_index()
-    )
-
-    teri_df = pivot_df_2[["country", "year", "GERI", "TERI"]]
-    teri_df = teri_df.copy()
-    teri_df.loc[:, "vaccine"] = "TERI"
-
-    tev_df = pivot_df_2[["country", "year", "GEV", "TEV"]]
-    tev_df = tev_df.copy()
-    tev_df.loc[:, "vaccine"] = "TEV"
-
-    tmp_df = teri_df.merge(tev_df, on=["country", "year"])
-
-    teri_df = teri_df.rename(columns={"GERI": "GE", "TERI": "TE"})
-    tev_df = tev_df.rename(columns={"GEV": "GE", "TEV": "TE"})
-
-    tmp_df["B"] = tmp_df["TEV"] / tmp_df["TERI"]
-    tmp_df = tmp_df[["country", "year", "B"]]
-
-    te_df = pd.concat([teri_df, tev_df], ignore_index=True)
-    new_df = pivot_df_1.merge(te_df, on=["country", "year"]).merge(
-        df[
-            [
-                "country_code",
-                "year",
-                "country",
-                "WHO_region",
-                "GAVI",
-                "surviving_infant",
-            ]
-        ].drop_duplicates(),
-        on=["country", "year"],
-    )
-    new_df = new_df.merge(tmp_df, on=["country", "year"])
-
-    # # new_df.fillna(0)
-    new_df["C"] = new_df["TE"] / new_df["surviving_infant"]
-    new_df["D"] = new_df["TE"] / new_df["LP"]
-    new_df["E"] = new_df["GE"] / new_df["TE"]
-    new_df["F"] = new_df["TE"] / new_df["NGDPD"]
-    new_df["G"] = new_df["TE"] / new_df["CHE_USD"]
-    new_df["H"] = new_df["TE"] / new_df["PHC_USD"]
-    new_df["I"] = new_df["TE"] / new_df["GGHED_USD"]
-    new_df["J"] = new_df["TE"] / new_df["EXT_USD"]
-    new_df = new_df.replace([np.inf, -np.inf], np.nan)
-    new_df = (
-        new_df.astype({"year": int})
-        .replace(update_names.keys(), update_names.values())
-        .round(3)
-    )
+    df = read_facts(AD_TYPES + FINANCE_CODES + ["surviving_infant"])
+    for column in AD_TYPES + FINANCE_CODES + ["surviving_infant"]:
+        df[column] = df[column].round(3)
+    df = df[df[AD_TYPES].notna().any(axis=1) & df[FINANCE_CODES].notna().any(axis=1)]
+    for column in AD_TYPES + FINANCE_CODES:
+        df[column] = df[column].fillna(0)
+    ratios = ratio_indicators(df, GGHED_RATIOS)
+    df = df.join(ratios.round(3))
 
     years = [y for y in range(2018, 2022)]
-    gghed_gge_df = (
-        new_df[["country", "country_code", "WHO_region", "GAVI", "year", "GGHED_GGE"]]
-        .drop_duplicates()
-        .sort_values(by="year")
-    )
+    gghed_gge_df = df[FACT_KEYS + ["GGHED_GGE"]].sort_values(by="year")
 
     process_comparator_country_data(gghed_gge_df, "GGHED_GGE", "gghed_gge", years)
     return
 
 
 def fin_sus_process():
-    df = parquet_to_df("MT_AD_IA2030")
-    df = (
-        df[df["TYPE"].isin(["GEV", "TEV"])]
-        .rename(
-            columns={
-                "COUNTRY": "country_code",
-                "NAMEWORKEN": "country",
-                "WHOREGIONC": "WHO_region",
-                "GAVI_INCOME_STATUS": "GAVI",
-                "YEAR": "year",
-                "TYPE": "vaccine",
-                "VALUE_TRANSFORMED": "expenditure",
-            }
-        )
-        .loc[
-            :,
-            [
-                "country_code",
-                "country",
-                "WHO_region",
-                "GAVI",
-                "year",
-                "vaccine",
-                "expenditure",
-            ],
-        ]
-    )
-    gev_df = df.loc[
-        df["vaccine"] == "GEV",
-        ["country_code", "year", "vaccine", "expenditure"],
-    ].rename(columns={"expenditure": "expenditure_gev"})
-    tev_df = df[df["vaccine"] == "TEV"].rename(
-        columns={"expenditure": "expenditure_tev"}
-    )
-    df = pd.merge(tev_df, gev_df, on=["country_code", "year"])
-    df["gev/tev"] = df["expenditure_gev"] / df["expenditure_tev"]
-    df.replace([np.inf, -np.inf], 0, inplace=True)
+    # gev/tev_sum: GEV/TEV in percent summed over the TEV x GEV row pairs of
+    # a country/year, gev/tev_pairs: pairs with a value
+    df = read_facts(["TEV_rows", "GEV_rows", "gev/tev_sum", "gev/tev_pairs"])
+    df = df[(df["TEV_rows"] > 0) & (df["GEV_rows"] > 0)]
+    share = (df["gev/tev_sum"] / df["gev/tev_pairs"]).astype(float) / 100
 
     conditions = [
-        df["gev/tev"].isna(),
-        df["gev/tev"] <= 0.2,
-        (df["gev/tev"] > 0.2) & (df["gev/tev"] <= 0.4),
-        (df["gev/tev"] > 0.4) & (df["gev/tev"] <= 0.6),
-        (df["gev/tev"] > 0.6) & (df["gev/tev"] <= 0.8),
-        df["gev/tev"] > 0.8,
+        share.isna(),
+        share <= 0.2,
+        (share > 0.2) & (share <= 0.4),
+        (share > 0.4) & (share <= 0.6),
+        (share > 0.6) & (share <= 0.8),
+        share > 0.8,
     ]
     df["group"] = np.select(conditions, [0, 1, 2, 3, 4, 5], default=0)
-    df = df.astype({"year": int}).replace(update_names.keys(), update_names.values())
-    df = df.round(4)
-    df["gev/tev"] = df["gev/tev"] * 100  #! This line change portion to percentage
 
     years = [y for y in range(2018, 2024)]
-    process_comparator_country_data(df, "gev/tev", "fin_sus", years)
+    process_comparator_country_data(
+        df, "gev/tev_sum", "fin_sus", years, weight="gev/tev_pairs", summed=True
+    )
     return
 
 
-def main():
+def code_files():
+    # this script and every module it imported from packages/
+    files = [os.path.abspath(__file__)]
+    for module in list(sys.modules.values()):
+        path = getattr(module, "__file__", None)
+        if path is not None and os.path.dirname(os.path.abspath(path)) == PACKAGES_PATH:
+            files.append(os.path.abspath(path))
+    return sorted(set(files))
+
+
+def input_fingerprint(inputs, hashes):
+    # inputs are raw table prefixes under data/ or file paths. The code and
+    # the output settings are always included, so a change to this script, to
+    # one of its packages or to the gold layout or compression rebuilds
+    # everything. hashes: path -> hash shared by the builders of a run, so a
+    # file read by several of them is hashed once
+    def hashed(file):
+        if file not in hashes:
+            hashes[file] = file_hash(file)
+        return hashes[file]
+
+    fingerprint = {
+        "WHDH_GOLD_LAYOUT": GOLD_LAYOUT,
+        "WHDH_GOLD_COMPRESS": ",".join(sorted(GOLD_COMPRESS)),
+    }
+    for file in code_files():
+        name = os.path.relpath(file, os.path.dirname(PACKAGES_PATH))
+        fingerprint[name] = hashed(file)
+    for item in inputs:
+        for file in [item] if os.path.isfile(item) else prefix_files(item):
+            fingerprint[file] = hashed(file)
+    return fingerprint
+
+
+def gold_outputs(filename):
+    return [
+        os.path.join("whdh_gold", f"{filename}_{suffix}.json")
+        for suffix in ["region", "gavi", "country"]
+    ]
+
+
+def load_build_manifest():
+    if not os.path.exists(BUILD_MANIFEST_PATH):
+        return {}
+    with open(BUILD_MANIFEST_PATH, "r") as json_file:
+        return json.load(json_file)
+
+
+def save_build_manifest(manifest):
+    with open(BUILD_MANIFEST_PATH + ".tmp", "w") as json_file:
+        json.dump(manifest, json_file, indent=4, sort_keys=True)
+    os.replace(BUILD_MANIFEST_PATH + ".tmp", BUILD_MANIFEST_PATH)
+
+
+def pandas_options():
+    # also the builder workers' initializer, spawned workers do not inherit
+    # options set in main()
+    pd.set_option("mode.copy_on_write", True)
     pd.set_option("future.no_silent_downcasting", True)
     pd.set_option("display.max_columns", None)
-    vaccine_spent_process()
-    risk_opportunity_process()
-    fiscal_distribution_process()
-    gghed_gge_process()
-    fin_sus_process()
+
+
+def main():
+    pandas_options()
+
+    # builder: (function, inputs it reads, files it writes, builders it reads
+    # from), the fact table is materialized first and every chart builder
+    # reads slices of it, the chart builders do not depend on each other
+    cy_ie_path = os.path.join("data", "cy_ie.parquet")
+    gni_paths = ["data/gni/current_gni.csv", "data/gni/constant_gni_2015.csv"]
+    builders = {
+        "country_year_facts": (
+            country_year_facts_process,
+            [
+                "MT_AD_IA2030",
+                "REF_POPULATION",
+                "REF_FINANCING",
+                "V_AD_COV_BOP",
+                cy_ie_path,
+            ]
+            + gni_paths,
+            [FACTS_PATH, LABELS_PATH]
+            + ([FACTS_IPC_PATH] if arrow_io.MEMORY_MAP else []),
+            [],
+        ),
+        "vaccine_spent": (
+            vaccine_spent_process,
+            ["MT_AD_IA2030", "REF_POPULATION"],
+            gold_outputs("vaccine_spent"),
+            ["country_year_facts"],
+        ),
+        "risk_opportunity": (
+            risk_opportunity_process,
+            ["MT_AD_IA2030", "V_AD_COV_BOP"],
+            gold_outputs("bop"),
+            ["country_year_facts"],
+        ),
+        "fiscal_distribution": (
+            fiscal_distribution_process,
+            ["MT_AD_IA2030", cy_ie_path],
+            gold_outputs("usd"),
+            ["country_year_facts"],
+        ),
+        "gghed_gge": (
+            gghed_gge_process,
+            ["MT_AD_IA2030", "REF_POPULATION", "REF_FINANCING"],
+            gold_outputs("gghed_gge"),
+            ["country_year_facts"],
+        ),
+        "fin_sus": (
+            fin_sus_process,
+            ["MT_AD_IA2030"],
+            gold_outputs("fin_sus"),
+            ["country_year_facts"],
+        ),
+    }
+
+    # only builders whose input hashes changed or whose outputs are missing
+    # are run, pass --full to rebuild everything. A builder whose fact table
+    # is already up to date does not wait for it
+    manifest = load_build_manifest()
+    fingerprints = {}
+    hashes = {}
+    tasks = {}
+    for name, (func, inputs, outputs, depends_on) in builders.items():
+        fingerprints[name] = input_fingerprint(inputs, hashes)
+        outputs_exist = all(os.path.exists(path) for path in outputs)
+        if (
+            "--full" in sys.argv
+            or manifest.get(name) != fingerprints[name]
+            or not outputs_exist
+        ):
+            tasks[name] = (func, [dep for dep in depends_on if dep in tasks])
+        else:
+            print(f"--- {name}: inputs unchanged ---")
+
+    start_time = time.time()
+    built = list(tasks)
+    if len(tasks) > 0:
+        # the fact table is the input every chart builder shares, it is built
+        # and loaded here once and the forked builders read it from
+        # raw_cache instead of each decoding the file again
+        if "country_year_facts" in tasks:
+            func, _ = tasks.pop("country_year_facts")
+            with run_metrics.stage("country_year_facts") as record:
+                func()
+            print("--- country_year_facts: %s seconds ---" % record["seconds"])
+            tasks = {
+                name: (func, [dep for dep in depends_on if dep in tasks])
+                for name, (func, depends_on) in tasks.items()
+            }
+        # the raw tables are only read by the fact table. The dimensions are
+        # built from its labels before the workers fork, so they share them
+        raw_cache.clear()
+        if len(tasks) > 0:
+            dimensions()
+            if not arrow_io.MEMORY_MAP:
+                parquet_file_to_df(FACTS_PATH)
+        run_graph(
+            tasks,
+            max_workers=int(os.getenv("WHDH_WORKERS", "5")),
+            initializer=pandas_options,
+        )
+    for name in built:
+        manifest[name] = fingerprints[name]
+    save_build_manifest(manifest)
+    print("--- total: %s seconds ---" % (time.time() - start_time))
+    run_metrics.write_report("whdh_gold_data")
 
     return 0
 
 
 if __name__ == "__main__":
-
-    update_names = {
-        "Gavi low income": "Low Income",
-        "non-Gavi middle income": "MIC (GAVI ineligible)",
-        "High income": "High Income",
-        "Gavi low-middle income": "MIC (GAVI eligible)",
-        "AFRO": "African Region",
-        "AMRO": "Americas Region",
-        "EMRO": "Eastern Mediterranean Region",
-        "EURO": "European Region",
-        "SEARO": "South-East Asian Region",
-        "WPRO": "Western Pacific Region",
-        "AFR": "African Region",
-        "AMR": "Americas Region",
-        "EMR": "Eastern Mediterranean Region",
-        "EUR": "European Region",
-        "SEAR": "South-East Asian Region",
-        "WPR": "Western Pacific Region",
-    }
     main()
@@ -1,70 +1,242 @@
 import sys
 import os
 import time
+import json
+import datetime
 import pandas as pd
+import pyarrow as pa
 
 sys.path.append(
     os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "packages"))
 )
 from xmart_extractor import XmartExtractor
+from parquet_sink import ParquetPageWriter
+import run_metrics
+from fingerprint import file_hash
 
+MANIFEST_PATH = "data/xmart_manifest.json"
 
-def extract_from_api(xmart):
+# MT_AD_IA2030_FINANCING
+# SURVIVING_INFANT <- REF_POPULATIONS
+# V_AD_COV_BOP_LONG
+# REF_IA2030_FINANCING <- REF_FINANCING
+# only the columns and rows read by imf_weo_required_columns.py and
+# whdh_gold_data.py are pulled, filter columns are kept so the downstream
+# filters still apply unchanged. Pages are parsed straight into arrow with
+# the declared schema, whose names are the $select
+TABLE_QUERIES = {
+    "REF_POPULATIONS": {
+        "schema": pa.schema(
+            [
+                ("COUNTRY_FK", pa.string()),
+                ("YEAR", pa.int64()),
+                ("VALUE", pa.float64()),
+                ("POP_SOURCE_FK", pa.string()),
+                ("GENDER_FK", pa.string()),
+                ("POP_TYPE_FK", pa.string()),
+            ]
+        ),
+        "filter": {
+            "POP_SOURCE_FK": "UNPD2022",
+            "GENDER_FK": "BOTH",
+            "POP_TYPE_FK": "SURVIVING_INFANT",
+        },
+    },
+    "V_AD_COV_BOP_LONG": {
+        "schema": pa.schema(
+            [
+                ("NAME", pa.string()),
+                ("YEAR", pa.int64()),
+                ("BOP", pa.float64()),
+            ]
+        ),
+        "filter": {},
+    },
+    "REF_FINANCING": {
+        "schema": pa.schema(
+            [
+                ("COUNTRY", pa.string()),
+                ("YEAR", pa.int64()),
+                ("INDCODE", pa.string()),
+                ("VALUE", pa.float64()),
+            ]
+        ),
+        "filter": {
+            "INDCODE": [
+                "LP",
+                "NGDPD",
+                "CHE_USD",
+                "PHC_USD",
+                "GGHED_USD",
+                "EXT_USD",
+                "GGHED_GGE",
+            ]
+        },
+    },
+    "AD_COVERAGES": {
+        "schema": pa.schema(
+            [
+                ("COUNTRY", pa.string()),
+                ("YEAR", pa.int64()),
+                ("VACCINECODE", pa.string()),
+                ("COVERAGE_CATEGORY", pa.string()),
+                ("PERCENTAGE", pa.float64()),
+                ("TARGETNUMBER", pa.float64()),
+            ]
+        ),
+        "filter": {"VACCINECODE": "DTPCV1", "COVERAGE_CATEGORY": "WUENIC"},
+    },
+    # every row is kept, risk_opportunity_process counts rows per country/year
+    "MT_AD_IA2030_FINANCING": {
+        "schema": pa.schema(
+            [
+                ("COUNTRY", pa.string()),
+                ("NAMEWORKEN", pa.string()),
+                ("WHOREGIONC", pa.string()),
+                ("GAVI_INCOME_STATUS", pa.string()),
+                ("YEAR", pa.int64()),
+                ("TYPE", pa.string()),
+                ("VALUE_TRANSFORMED", pa.float64()),
+            ]
+        ),
+        "filter": {},
+    },
+}
 
-    # MT_AD_IA2030_FINANCING
-    # SURVIVING_INFANT <- REF_POPULATIONS
-    # V_AD_COV_BOP_LONG
-    # REF_IA2030_FINANCING <- REF_FINANCING
-    tables = [
-        "REF_POPULATIONS",
-        "V_AD_COV_BOP_LONG",
-        "REF_FINANCING",
-        "AD_COVERAGES",
-        "MT_AD_IA2030_FINANCING",
-    ]
+
+def load_manifest():
+    if not os.path.exists(MANIFEST_PATH):
+        return {}
+    with open(MANIFEST_PATH, "r") as json_file:
+        return json.load(json_file)
+
+
+def save_manifest(manifest):
+    with open(MANIFEST_PATH + ".tmp", "w") as json_file:
+        json.dump(manifest, json_file, indent=4, sort_keys=True)
+    os.replace(MANIFEST_PATH + ".tmp", MANIFEST_PATH)
+
+
+def stale_queries(xmart, queries, manifest, refresh_years):
+    # years in refresh_years are always pulled, older years only when the
+    # server side $count differs from the manifest, the local file is gone or
+    # the query changed (e.g. a column was added to TABLE_QUERIES)
+    stale = {}
+    check = {}
+    for (table, year), path in queries.items():
+        entry = manifest.get(table, {}).get(str(year))
+        if year in refresh_years or entry is None:
+            stale[(table, year)] = path
+        elif entry.get("query") != path:
+            stale[(table, year)] = path
+        elif entry["rows"] > 0 and not os.path.exists(
+            f"data/{table}_{str(year)}.parquet"
+        ):
+            stale[(table, year)] = path
+        elif os.path.exists(f"data/{table}_{str(year)}.parquet.pages"):
+            # an interrupted pull, finish it
+            stale[(table, year)] = path
+        else:
+            check[(table, year)] = path
+
+    counts = xmart.counts(check)
+    for (table, year), path in check.items():
+        if counts[(table, year)] != manifest[table][str(year)]["rows"]:
+            stale[(table, year)] = path
+    return {key: path for key, path in queries.items() if key in stale}
+
+
+def extract_from_api(xmart, incremental=True):
 
     start_year = 2018
     end_year = 2025
     years = list(range(start_year, end_year + 1))
     # years_str = ",".join([str(year) for year in years])
 
-    for year in years:
-        chunk = 10000
-        for table in tables:
-            skip = 0
-            top = chunk
-
-            stop = False
-            merged_df = None
-            while not stop:
-                start_time = time.time()
-                response = xmart.get(
-                    f"{table}?$top={top}&$skip={skip}&$filter=YEAR in ({str(year)})"
-                )
-                data = response["value"]
-                print("--- %s seconds ---" % (time.time() - start_time))
-                if len(data) == 0:
-                    stop = True
-                    continue
-                else:
-                    df = pd.json_normalize(data)
-                    if merged_df is None:
-                        merged_df = df
-                    else:
-                        merged_df = pd.concat([merged_df, df], ignore_index=True)
-                    skip = skip + chunk
-                    continue
-            if merged_df is not None:
-                print("done and saving as parquet")
-                merged_df.to_parquet(
-                    f"data/{table}_{str(year)}.parquet", engine="pyarrow"
-                )
+    queries = {
+        (table, year): xmart.query(
+            table,
+            select=spec["schema"].names,
+            filter={"YEAR": [year], **spec["filter"]},
+        )
+        for year in years
+        for table, spec in TABLE_QUERIES.items()
+    }
+
+    manifest = load_manifest()
+    if incremental:
+        this_year = datetime.date.today().year
+        queries = stale_queries(xmart, queries, manifest, [this_year - 1, this_year])
+        print(f"{len(queries)} table/years to refresh")
+
+    # pages arrive per table/year in $skip order while the extractor keeps
+    # fetching the following pages and table/years on its worker pool, each
+    # page is checkpointed so an interrupted run resumes where it stopped
+    chunk = 10000
+    writers = {
+        (table, year): ParquetPageWriter(f"data/{table}_{str(year)}.parquet", path)
+        for (table, year), path in queries.items()
+    }
+    start = {key: writer.next_skip for key, writer in writers.items()}
+    schemas = {key: TABLE_QUERIES[key[0]]["schema"] for key in queries}
+    # a table/year is timed from its first request, which goes out while the
+    # table/years before it are still being fetched and written
+    first_request = {}
+    pages = xmart.iter_pages(
+        queries,
+        chunk=chunk,
+        start=start,
+        schemas=schemas,
+        first_request=first_request,
+    )
+    for key, skip, data in pages:
+        writer = writers[key]
+        if len(data) > 0:
+            writer.write(data, skip)
+            run_metrics.add("rows_in", len(data))
+            continue
+
+        # the empty page closes the table/year, table/years without any rows
+        # are recorded too so they are not pulled again until $count changes
+        table, year = key
+        seconds = time.time() - first_request[key]
+        print("--- %s seconds ---" % seconds)
+        written = 0
+        if len(writer.pages) > 0:
+            print("done and saving as parquet")
+            writer.close()
+            written = run_metrics.path_bytes(writer.path)
+            record_sync(
+                manifest, table, year, writer.query, writer.rows, file_hash(writer.path)
+            )
+        else:
+            record_sync(manifest, table, year, writer.query, 0, None)
+        save_manifest(manifest)
+        run_metrics.add("rows_out", writer.rows)
+        run_metrics.add("bytes_written", written)
+        run_metrics.record(
+            f"extract {table}_{year}",
+            seconds=round(seconds, 3),
+            rows_out=writer.rows,
+            bytes_written=written,
+        )
+
+
+def record_sync(manifest, table, year, query, rows, content_hash):
+    manifest.setdefault(table, {})[str(year)] = {
+        "query": query,
+        "rows": rows,
+        "sha256": content_hash,
+        "synced_at": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+    }
 
 
 def main():
     pd.set_option("display.max_columns", None)
-    xmart = XmartExtractor()
-    extract_from_api(xmart)
+    xmart = XmartExtractor(max_workers=8)
+    with run_metrics.stage("extract"):
+        extract_from_api(xmart, incremental="--full" not in sys.argv)
+    run_metrics.write_report("xmart_parquet")
     return 0
 
 
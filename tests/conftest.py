@@ -0,0 +1,7 @@
+import os
+import sys
+
+# the scripts and packages are imported the way the scripts import them
+ROOT_PATH = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+sys.path.append(os.path.join(ROOT_PATH, "packages"))
+sys.path.append(os.path.join(ROOT_PATH, "scripts"))
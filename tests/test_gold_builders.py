@@ -0,0 +1,334 @@
+import contextlib
+import glob
+import io
+import json
+import math
+import os
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import benchmark
+import imf_weo_csv_parquet
+import imf_weo_required_columns
+import run_metrics
+import whdh_gold_data
+
+# countries x years x units of the synthetic data
+SCALE = "400x8x2"
+
+# builder: (function, fact table columns it reads, gold file prefix, budget).
+# budget bounds what the builder's transforms allocate on top of the slice of
+# the fact table it reads, up to handing its frame to the comparators, in
+# units of that slice. Transforms scoped to the columns they change stay
+# under it, a copy of the whole frame goes over. fiscal_distribution adds its
+# threshold groups, gghed_gge filters 17 rounded columns
+BUILDERS = {
+    "vaccine_spent": (
+        whdh_gold_data.vaccine_spent_process,
+        ["TEV_per_infant", "TERI_per_infant"],
+        "vaccine_spent",
+        0.75,
+    ),
+    "risk_opportunity": (
+        whdh_gold_data.risk_opportunity_process,
+        ["ad_rows", "BOP"],
+        "bop",
+        0.75,
+    ),
+    "fiscal_distribution": (
+        whdh_gold_data.fiscal_distribution_process,
+        ["LCU", "USD"],
+        "usd",
+        1.25,
+    ),
+    "gghed_gge": (
+        whdh_gold_data.gghed_gge_process,
+        whdh_gold_data.AD_TYPES + whdh_gold_data.FINANCE_CODES + ["surviving_infant"],
+        "gghed_gge",
+        1.5,
+    ),
+    "fin_sus": (
+        whdh_gold_data.fin_sus_process,
+        ["TEV_rows", "GEV_rows", "gev/tev_sum", "gev/tev_pairs"],
+        "fin_sus",
+        0.75,
+    ),
+}
+OPTIONS = ["mode.copy_on_write", "future.no_silent_downcasting", "display.max_columns"]
+
+
+@contextlib.contextmanager
+def pipeline(work_path, scale, edit=None):
+    # the pipeline up to the fact table on synthetic data, edit(data_path)
+    # changes the raw tables first
+    countries, years, units = benchmark.parse_scale(scale)
+    benchmark.generate(str(work_path / "data"), countries, years, units)
+    if edit is not None:
+        edit(str(work_path / "data"))
+    os.makedirs(work_path / "whdh_gold")
+
+    previous = [
+        value for option in OPTIONS for value in (option, pd.get_option(option))
+    ]
+    whdh_gold_data.raw_cache.clear()
+    whdh_gold_data.dimensions.cache_clear()
+    with pytest.MonkeyPatch.context() as patch, pd.option_context(*previous):
+        patch.chdir(work_path)
+        whdh_gold_data.pandas_options()
+        with contextlib.redirect_stdout(io.StringIO()):
+            imf_weo_csv_parquet.main()
+            imf_weo_required_columns.required_columns()
+        whdh_gold_data.country_year_facts_process()
+        yield
+    whdh_gold_data.raw_cache.clear()
+    whdh_gold_data.dimensions.cache_clear()
+
+
+@pytest.fixture(scope="module")
+def fact_table(tmp_path_factory):
+    # loaded into the cache the way main() does before the builders fork
+    with pipeline(tmp_path_factory.mktemp("gold"), SCALE):
+        whdh_gold_data.dimensions()
+        whdh_gold_data.raw_cache.clear()
+        whdh_gold_data.parquet_file_to_df(whdh_gold_data.LABELS_PATH)
+        whdh_gold_data.parquet_file_to_df(whdh_gold_data.FACTS_PATH)
+        yield
+
+
+@pytest.fixture
+def traced(monkeypatch):
+    # every builder is traced from its own start
+    monkeypatch.setattr(run_metrics, "TRACEMALLOC", True)
+    yield
+    tracemalloc.stop()
+
+
+@pytest.mark.parametrize("name", list(BUILDERS))
+def test_builder_peak_allocation(fact_table, traced, monkeypatch, name):
+    func, columns, filename, budget = BUILDERS[name]
+    frame = whdh_gold_data.read_facts(columns)
+    slice_mb = frame.memory_usage(index=True, deep=True).sum() / 1024**2
+
+    # traced allocation held once the slice is read, plus the ratios once
+    # they are computed, and the peaks of the transforms on top of it up to
+    # the comparators. The ratio step is measured on its own, against the
+    # ratios it returns
+    held = []
+    transform_mb = []
+    ratio_mb = []
+    read_facts = whdh_gold_data.read_facts
+    ratio_indicators = whdh_gold_data.ratio_indicators
+    emit = whdh_gold_data.process_comparator_country_data
+
+    def measured_read(*args, **kwargs):
+        df = read_facts(*args, **kwargs)
+        held.append(tracemalloc.get_traced_memory()[0])
+        tracemalloc.reset_peak()
+        return df
+
+    def measured_ratios(*args, **kwargs):
+        current, peak = tracemalloc.get_traced_memory()
+        transform_mb.append((peak - held[0]) / 1024**2)
+        tracemalloc.reset_peak()
+        ratios = ratio_indicators(*args, **kwargs)
+        ratios_bytes = ratios.memory_usage(index=False).sum()
+        peak = tracemalloc.get_traced_memory()[1]
+        ratio_mb.append(((peak - current) / 1024**2, ratios_bytes / 1024**2))
+        held[0] = held[0] + ratios_bytes
+        tracemalloc.reset_peak()
+        return ratios
+
+    def measured_emit(*args, **kwargs):
+        peak = tracemalloc.get_traced_memory()[1]
+        transform_mb.append((peak - held[0]) / 1024**2)
+        emit(*args, **kwargs)
+
+    monkeypatch.setattr(whdh_gold_data, "read_facts", measured_read)
+    monkeypatch.setattr(whdh_gold_data, "ratio_indicators", measured_ratios)
+    monkeypatch.setattr(
+        whdh_gold_data, "process_comparator_country_data", measured_emit
+    )
+    with run_metrics.stage(name) as record:
+        func()
+
+    for path in whdh_gold_data.gold_outputs(filename):
+        assert os.path.exists(path)
+    assert "peak_alloc_mb" in record
+    assert max(transform_mb) < budget * slice_mb, (
+        f"{name} transforms allocated {max(transform_mb):.2f} MB on top of the "
+        f"{slice_mb:.2f} MB slice it reads"
+    )
+    # the ratios and the mask of their infinite values
+    for step_mb, ratios_mb in ratio_mb:
+        assert step_mb < 1.5 * ratios_mb, (
+            f"ratio_indicators allocated {step_mb:.2f} MB for {ratios_mb:.2f} MB "
+            "of ratios"
+        )
+
+
+def test_unweighted_rollup_matches_plain_means():
+    # every level of the one pass rollup against a group-by mean of its own,
+    # several rows per country/year, missing values and an unlabelled region
+    rng = np.random.default_rng(0)
+    rows = 3000
+    country = rng.integers(0, 120, rows)
+    df = pd.DataFrame(
+        {
+            "WHO_region": pd.Series(country % 6).map(
+                {0: "AFR", 1: "AMR", 2: "EMR", 3: "EUR", 4: "SEAR"}
+            ),
+            "GAVI": (country % 4).astype(str),
+            "country": [f"C{c:03d}" for c in country],
+            "year": rng.integers(2015, 2024, rows),
+            "value": np.where(
+                rng.random(rows) < 0.2, np.nan, rng.normal(50, 30, rows).round(3)
+            ),
+        }
+    )
+    levels = ["WHO_region", "GAVI", "country"]
+    rollups = whdh_gold_data.comparator_values(df, levels, "value")
+    for level in levels:
+        means, present = rollups[level]
+        expected = df.groupby([level, "year"])["value"].mean().unstack("year")
+        expected_present = df.groupby([level, "year"]).size().unstack("year") > 0
+        pd.testing.assert_frame_equal(
+            means, expected, check_names=False, rtol=1e-12, atol=0
+        )
+        pd.testing.assert_frame_equal(
+            present, expected_present.fillna(False), check_names=False
+        )
+
+
+def relabel_mid_series(data_path):
+    # C0001 and C0002 become High income from 2020, C0003 moves from EURO to
+    # AFR from 2021 and C0000 is published as AFR instead of AFRO from 2021
+    changes = [
+        (["C0001", "C0002"], 2020, "GAVI_INCOME_STATUS", "High income"),
+        (["C0003", "C0000"], 2021, "WHOREGIONC", "AFR"),
+    ]
+    for path in glob.glob(os.path.join(data_path, "MT_AD_IA2030_FINANCING_*")):
+        ad_df = pd.read_parquet(path)
+        for countries, year, column, label in changes:
+            rows = ad_df["COUNTRY"].isin(countries) & (ad_df["YEAR"] >= year)
+            ad_df.loc[rows, column] = label
+        ad_df.to_parquet(path, index=False)
+
+
+def read_raw(prefix):
+    return pd.concat(
+        [pd.read_parquet(path) for path in sorted(glob.glob(f"data/{prefix}_*"))],
+        ignore_index=True,
+    ).rename(
+        columns={
+            "COUNTRY": "country_code",
+            "NAMEWORKEN": "country",
+            "WHOREGIONC": "WHO_region",
+            "GAVI_INCOME_STATUS": "GAVI",
+            "YEAR": "year",
+        }
+    )
+
+
+def relabel(df):
+    for column in whdh_gold_data.LABELS:
+        df[column] = df[column].replace(whdh_gold_data.update_names)
+    return df
+
+
+def expected_comparators(df, column_name, years):
+    # the comparators as the original builders wrote them, a group-by mean
+    # per level over the joined rows
+    expected = {}
+    for level, suffix in [("WHO_region", "region"), ("GAVI", "gavi")]:
+        means = df.groupby([level, "year"])[column_name].mean()
+        expected[suffix] = {}
+        for (entity, year), value in means.items():
+            cells = expected[suffix].setdefault(entity, {})
+            if year in years:
+                cells[str(year)] = None if math.isnan(value) else round(value, 2)
+    return expected
+
+
+def gold_comparators(filename):
+    gold = {}
+    for suffix in ["region", "gavi"]:
+        with open(os.path.join("whdh_gold", f"{filename}_{suffix}.json")) as f:
+            gold[suffix] = json.load(f)
+    return gold
+
+
+@pytest.fixture(scope="module")
+def relabelled(tmp_path_factory):
+    with pipeline(tmp_path_factory.mktemp("relabelled"), "12x6x2", relabel_mid_series):
+        yield
+
+
+def test_vaccine_spent_counts_every_label_of_a_country(relabelled):
+    # a country/year counts in every region and GAVI group the country's
+    # TEV/TERI rows ever carried, once per label after relabelling
+    whdh_gold_data.vaccine_spent_process()
+
+    ad_df = read_raw("MT_AD_IA2030_FINANCING")
+    ad_df = ad_df[ad_df["TYPE"].isin(["TEV", "TERI"])]
+    pop_df = read_raw("REF_POPULATIONS")
+    pop_df = pop_df[pop_df["POP_TYPE_FK"] == "SURVIVING_INFANT"].rename(
+        columns={"COUNTRY_FK": "country_code", "VALUE": "infant"}
+    )
+    df = pd.merge(ad_df, pop_df, on=["country_code", "year"], how="left")
+    df["per_infant"] = (df["VALUE_TRANSFORMED"] / df["infant"]).round(3)
+    df = relabel(df)
+    labels_df = df[["country", "country_code"] + ["WHO_region", "GAVI"]]
+    per_infant = df.pivot_table(
+        values="per_infant", index=["country", "year"], columns="TYPE"
+    ).reset_index()
+    df = pd.merge(labels_df.drop_duplicates(), per_infant, on="country")
+    df = df[(df["TEV"] != 0) & (df["TERI"] != 0)]
+
+    expected = expected_comparators(df, "TEV", range(2018, 2024))
+    assert gold_comparators("vaccine_spent") == expected
+    assert "2018" in expected["gavi"]["High Income"]
+
+
+def test_usd_counts_every_raw_label_of_a_country(relabelled):
+    # every cy_ie year of a country counts in every region and GAVI group of
+    # its MT_AD_IA2030 rows, once per raw label, so AFR and AFRO count twice
+    whdh_gold_data.fiscal_distribution_process()
+
+    labels_df = read_raw("MT_AD_IA2030_FINANCING")[
+        ["country_code", "country", "WHO_region", "GAVI"]
+    ].drop_duplicates()
+    cy_ie_df = pd.read_parquet("data/cy_ie.parquet").rename(
+        columns={"GGX_MinusInterestPayments_ConstantUSD_percapita_rebased": "USD"}
+    )[["country_code", "year", "USD"]]
+    df = relabel(pd.merge(labels_df, cy_ie_df, on="country_code", how="left"))
+    df["USD"] = df["USD"].round(3)
+
+    expected = expected_comparators(df, "USD", range(2023, 2030))
+    assert gold_comparators("usd") == expected
+
+
+def test_inputs_shared_by_builders_are_hashed_once(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    os.makedirs("data")
+    for name in ["MT_AD_IA2030_2020", "MT_AD_IA2030_2021", "REF_FINANCING_2020"]:
+        with open(os.path.join("data", f"{name}.parquet"), "wb") as f:
+            f.write(name.encode())
+    hashed = []
+    file_hash = whdh_gold_data.file_hash
+
+    def counted(path):
+        hashed.append(path)
+        return file_hash(path)
+
+    monkeypatch.setattr(whdh_gold_data, "file_hash", counted)
+    hashes = {}
+    first = whdh_gold_data.input_fingerprint(["MT_AD_IA2030"], hashes)
+    second = whdh_gold_data.input_fingerprint(["MT_AD_IA2030", "REF_FINANCING"], hashes)
+
+    assert len(hashed) == len(set(hashed))
+    assert len(hashes) == len(hashed)
+    assert set(whdh_gold_data.prefix_files("MT_AD_IA2030")) <= set(hashed)
+    assert {key: second[key] for key in first} == first
@@ -0,0 +1,200 @@
+import threading
+import time
+
+import pandas as pd
+import pytest
+from azure.core.credentials import AccessToken
+
+import benchmark
+import xmart_extractor
+from parquet_sink import ParquetPageWriter
+from xmart_extractor import XmartExtractor
+
+ROWS = 25
+
+
+class FaultyHandler(benchmark.ODataHandler):
+    # answers with the next scripted fault before serving the page: an HTTP
+    # status with headers, or "stall" to hold the response past the timeout
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.requests.append((self.path, self.headers.get("Authorization")))
+            fault = server.faults.pop(0) if len(server.faults) > 0 else None
+            token = server.valid_token
+        if fault == "stall":
+            threading.Event().wait(0.5)
+        elif fault is not None:
+            status, headers = fault
+            self.send_error_response(status, headers)
+            return
+        if token is not None and self.headers.get("Authorization") != token:
+            self.send_error_response(401, {})
+            return
+        super().do_GET()
+
+    def send_error_response(self, status, headers):
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+
+class FaultyStub(benchmark.ODataStub):
+    def __init__(self, data_path):
+        super().__init__(data_path)
+        self.RequestHandlerClass = FaultyHandler
+        self.faults = []
+        self.requests = []
+        self.valid_token = None
+
+
+class FakeCredential:
+    # hands out token1, token2, ... valid for lifetime seconds
+    def __init__(self, lifetime=3600):
+        self.lifetime = lifetime
+        self.issued = 0
+
+    def get_token(self, scope):
+        self.issued += 1
+        return AccessToken(f"token{self.issued}", int(time.time()) + self.lifetime)
+
+
+@pytest.fixture
+def stub(tmp_path):
+    pd.DataFrame(
+        {
+            "COUNTRY": [f"C{i:04d}" for i in range(ROWS)],
+            "YEAR": 2020,
+            "VALUE": [float(i) for i in range(ROWS)],
+        }
+    ).to_parquet(tmp_path / "REF_FINANCING_2020.parquet", index=False)
+    server = FaultyStub(str(tmp_path))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def sleeps(monkeypatch):
+    # backoff and Retry-After waits are recorded instead of slept
+    waited = []
+    monkeypatch.setattr(xmart_extractor.time, "sleep", waited.append)
+    return waited
+
+
+@pytest.fixture
+def xmart(stub, monkeypatch):
+    for name in ["AUTHN_APP", "AUTHN_PASSWORD", "AUTHN_TENANT"]:
+        monkeypatch.setenv(name, "test")
+    monkeypatch.setenv("AUTHN_RESOURCE", "http://127.0.0.1")
+    extractor = XmartExtractor(max_workers=2, max_retries=3, timeout=(1.0, 0.2))
+    extractor.base_url = f"http://127.0.0.1:{stub.server_address[1]}/"
+    extractor.credential = FakeCredential()
+    return extractor
+
+
+def test_retry_after_is_honoured_on_429_and_503(stub, xmart, sleeps):
+    stub.faults = [(429, {"Retry-After": "7"}), (503, {"Retry-After": "2"})]
+    data = xmart.get("REF_FINANCING?$top=5&$skip=0")
+    assert len(data["value"]) == 5
+    assert sleeps == [7.0, 2.0]
+    assert len(stub.requests) == 3
+
+
+def test_retries_give_up_with_http_error(stub, xmart, sleeps):
+    stub.faults = [(503, {})] * (xmart.max_retries + 1)
+    with pytest.raises(xmart_extractor.requests.HTTPError):
+        xmart.get("REF_FINANCING?$top=5&$skip=0")
+    assert len(stub.requests) == xmart.max_retries + 1
+    # jittered exponential backoff without Retry-After
+    assert all(
+        0 <= wait <= xmart.backoff * 2**attempt for attempt, wait in enumerate(sleeps)
+    )
+
+
+def test_stalled_response_times_out_and_is_retried(stub, xmart, sleeps):
+    stub.faults = ["stall"]
+    data = xmart.get("REF_FINANCING?$top=5&$skip=0")
+    assert len(data["value"]) == 5
+    assert len(stub.requests) == 2
+
+
+def test_token_is_refreshed_after_401(stub, xmart, sleeps):
+    xmart.token()
+    # the server stops accepting token1, e.g. it was revoked
+    stub.valid_token = "Bearer token2"
+    data = xmart.get("REF_FINANCING?$top=5&$skip=0")
+    assert len(data["value"]) == 5
+    assert [auth for _, auth in stub.requests] == ["Bearer token1", "Bearer token2"]
+
+
+def test_token_is_renewed_before_it_expires(stub, xmart, sleeps):
+    xmart.credential = FakeCredential(lifetime=60)
+    xmart.get("REF_FINANCING?$top=5&$skip=0")
+    xmart.get("REF_FINANCING?$top=5&$skip=5")
+    # token1 expires within five minutes, so the second request gets token2
+    assert [auth for _, auth in stub.requests] == ["Bearer token1", "Bearer token2"]
+
+
+def test_interrupted_pull_resumes_from_checkpoint(stub, xmart, sleeps, tmp_path):
+    path = str(tmp_path / "out.parquet")
+    query = xmart.query("REF_FINANCING", select=["COUNTRY", "VALUE"])
+    chunk = 10
+
+    writer = ParquetPageWriter(path, query)
+    for key, skip, data in xmart.iter_pages({"q": query}, chunk=chunk):
+        writer.write(pd.DataFrame(data), skip)
+        # the pull dies after its first page
+        break
+
+    stub.requests.clear()
+    writer = ParquetPageWriter(path, query)
+    assert writer.next_skip == chunk
+    for key, skip, data in xmart.iter_pages(
+        {"q": query}, chunk=chunk, start={"q": writer.next_skip}
+    ):
+        if len(data) > 0:
+            writer.write(pd.DataFrame(data), skip)
+    writer.close()
+
+    skips = sorted(int(path.split("$skip=")[1]) for path, _ in stub.requests)
+    assert skips[0] == chunk
+    result = pd.read_parquet(path)
+    assert result["COUNTRY"].tolist() == [f"C{i:04d}" for i in range(ROWS)]
+    assert writer.rows == ROWS
+
+
+def test_checkpoint_of_another_query_is_discarded(stub, xmart, sleeps, tmp_path):
+    path = str(tmp_path / "out.parquet")
+    query = xmart.query("REF_FINANCING", select=["COUNTRY", "VALUE"])
+    writer = ParquetPageWriter(path, query)
+    for key, skip, data in xmart.iter_pages({"q": query}, chunk=10):
+        writer.write(pd.DataFrame(data), skip)
+        break
+
+    writer = ParquetPageWriter(path, xmart.query("REF_FINANCING", select=["VALUE"]))
+    assert writer.next_skip == 0
+    assert writer.pages == []
+
+
+def test_first_request_of_a_key_is_recorded(stub, xmart, sleeps):
+    # the next key's first page goes out while the caller is still on the
+    # previous one, its time starts there and not when the previous one ends
+    query = xmart.query("REF_FINANCING", select=["COUNTRY", "VALUE"])
+    first_request = {}
+    closed = {}
+    start_time = time.time()
+    pages = xmart.iter_pages(
+        {"a": query, "b": query}, chunk=10, first_request=first_request
+    )
+    for key, skip, data in pages:
+        threading.Event().wait(0.1)
+        if len(data) == 0:
+            closed[key] = time.time()
+
+    assert set(first_request) == {"a", "b"}
+    assert start_time <= first_request["a"] <= first_request["b"]
+    assert first_request["b"] < closed["a"]